@@ -0,0 +1 @@
+# Бенчмарки конвейера расписания: python -m benchmarks.bench_schedule
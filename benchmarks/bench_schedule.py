@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+# config требует токен, но бенчмарки в Telegram не ходят.
+os.environ.setdefault("TOKEN_BOT", "benchmark")
+
+import shedule  # noqa: E402
+from benchmarks.sheet_generator import generate_sheet_csv, make_variants  # noqa: E402
+from utils import send_long_text  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Размер таблицы: (параллелей, классов в параллели)
+SIZES = {
+    "small": (1, 13),
+    "medium": (7, 13),
+    "large": (7, 50),
+}
+
+# Во сколько раз можно быть медленнее базовой линии, пока это не регрессия.
+DEFAULT_TOLERANCE = 3.0
+
+
+class _NullMessage:
+    # Вместо aiogram Message: send_long_text меряется без сети.
+    async def answer(self, text: str, **kwargs) -> None:
+        return None
+
+
+def _measure(run: Callable[[int], float], repeat: int = 5, min_time: float = 0.05) -> float:
+    # run(n) выполняет n вызовов и возвращает затраченное время.
+    # Результат — медиана времени одного вызова в микросекундах.
+    number = 1
+    while True:
+        elapsed = run(number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        timings.append(run(number) / number)
+
+    return statistics.median(timings) * 1_000_000
+
+
+def _sync(func: Callable[[], object]) -> Callable[[int], float]:
+    def run(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - start
+
+    return run
+
+
+def _async(loop: asyncio.AbstractEventLoop, func: Callable[[], object]) -> Callable[[int], float]:
+    async def batch(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - start
+
+    def run(number: int) -> float:
+        return loop.run_until_complete(batch(number))
+
+    return run
+
+
+def _warm_cache(csv_text: str, index: shedule.ScheduleIndex) -> None:
+    # Кэш как после удачного обновления: таблица свежая, индекс собран.
+    for sheet in shedule._sheets.values():
+        sheet.csv_text = csv_text
+        sheet.cached_at = datetime.utcnow()
+        sheet.index = index
+    shedule._rebuild_index()
+
+
+def run_size(parallels: int, variants: int) -> Dict[str, float]:
+    csv_text = generate_sheet_csv(parallels, variants)
+    index = shedule.build_schedule_index(csv_text)
+    _warm_cache(csv_text, index)
+
+    variant = make_variants(variants)[-1]
+    schedule = index.get("5", variant)
+    assert schedule is not None, "генератор и парсер разошлись"
+    day, lessons = next(iter(schedule.days.items()))
+    seed = f"{schedule.label}|{day}|{schedule.version}"
+
+    week_texts = [shedule.render_full_schedule(s) for s in list(index.classes.values())[:10]]
+    long_text = "\n\n".join(week_texts)
+    message = _NullMessage()
+
+    def render_cold() -> str:
+        shedule._render_cache.clear()
+        return shedule.render_full_schedule(schedule)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = {
+            "parse": _measure(_sync(lambda: shedule.build_schedule_index(csv_text)), repeat=3),
+            "lookup": _measure(_sync(lambda: index.get("5", variant))),
+            "fetch_cached": _measure(_async(loop, lambda: shedule.get_class_schedule("5", variant))),
+            "fill_free_time": _measure(
+                _sync(lambda: shedule._fill_missing_lessons_with_free_time(lessons, seed))
+            ),
+            "render_full_cold": _measure(_sync(render_cold)),
+            "render_full_cached": _measure(_sync(lambda: shedule.render_full_schedule(schedule))),
+            "send_long_text": _measure(_async(loop, lambda: send_long_text(message, long_text))),
+        }
+    finally:
+        loop.close()
+        shedule.shutdown_parse_executor()
+
+    return results
+
+
+def _load_baseline() -> Optional[dict]:
+    if not os.path.exists(BASELINE_FILE):
+        return None
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки расписания")
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=list(SIZES))
+    parser.add_argument("--record", action="store_true", help="записать результаты как базовую линию")
+    parser.add_argument("--tolerance", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    baseline = _load_baseline()
+    tolerance = args.tolerance or (baseline or {}).get("tolerance", DEFAULT_TOLERANCE)
+    base_results = (baseline or {}).get("results", {})
+
+    all_results: Dict[str, Dict[str, float]] = {}
+    regressions: List[str] = []
+
+    for size in args.sizes:
+        parallels, variants = SIZES[size]
+        print(f"== {size}: {parallels} параллелей x {variants} классов")
+        results = run_size(parallels, variants)
+        all_results[size] = results
+
+        for name, value in results.items():
+            line = f"  {name:<20} {value:>12.1f} мкс"
+            base = base_results.get(size, {}).get(name)
+            if base:
+                ratio = value / base
+                line += f"   x{ratio:.2f} от базы"
+                if ratio > tolerance:
+                    line += "  РЕГРЕССИЯ"
+                    regressions.append(f"{size}/{name}")
+            print(line)
+
+    if args.record:
+        data = {
+            "tolerance": tolerance,
+            "python": sys.version.split()[0],
+            "results": {**base_results, **all_results},
+        }
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"Базовая линия записана в {BASELINE_FILE}")
+        return 0
+
+    if regressions:
+        print(f"Медленнее базы больше чем в {tolerance} раза: {', '.join(regressions)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
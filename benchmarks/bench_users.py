@@ -0,0 +1,162 @@
+import argparse
+import json
+import mmap
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+# config требует токен, но бенчмарки в Telegram не ходят.
+os.environ.setdefault("TOKEN_BOT", "benchmark")
+
+from benchmarks.sheet_generator import make_variants  # noqa: E402
+from user_registry import UserRegistry  # noqa: E402
+
+# Число синтетических пользователей
+SIZES = {
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+
+# Во сколько раз users.bin должен грузиться быстрее json.load.
+DEFAULT_MIN_SPEEDUP = 10.0
+
+FIRST_NAMES = ["Иван", "Мария", "Алексей", "Анна", "Дмитрий", "Елена", "Сергей", "Ольга"]
+LAST_NAMES = ["Иванов", "Петрова", "Смирнов", "Кузнецова", "Попов", "Соколова", "Лебедев"]
+
+
+def generate_users(count: int, seed: int = 1):
+    # Профили как у настоящих пользователей: у большинства выбран класс,
+    # у части — ещё и чужой, у некоторых нет ничего, кроме chat_id.
+    rnd = random.Random(seed)
+    variants = make_variants(13)
+    parallels = [str(number) for number in range(5, 12)]
+
+    user_settings: Dict[int, dict] = {}
+    known_users: List[int] = []
+    chat_ids = rnd.sample(range(10_000_000, 8_000_000_000), count)
+    for chat_id in chat_ids:
+        known_users.append(chat_id)
+        if rnd.random() < 0.1:
+            user_settings[chat_id] = {}
+            continue
+
+        settings = {
+            "first_name": f"{rnd.choice(FIRST_NAMES)}{rnd.randrange(1000)}",
+            "last_name": rnd.choice(LAST_NAMES),
+            "parallel": rnd.choice(parallels),
+            "variant": rnd.choice(variants),
+        }
+        if rnd.random() < 0.3:
+            settings["other_parallel"] = rnd.choice(parallels)
+            settings["other_variant"] = rnd.choice(variants)
+        if rnd.random() < 0.2:
+            settings["notify_changes"] = False
+        user_settings[chat_id] = settings
+
+    return user_settings, known_users
+
+
+def _write_json(path: str, user_settings: Dict[int, dict], known_users: List[int]) -> None:
+    # Тот же формат, что раньше писал storage.save_state.
+    data = {
+        "user_settings": {str(chat_id): settings for chat_id, settings in user_settings.items()},
+        "known_users": sorted(known_users),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def _load_json(path: str) -> int:
+    # json.load и разбор в dict, как делала старая загрузка.
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    user_settings = {int(key): value for key, value in data["user_settings"].items()}
+    known_users = {int(item) for item in data["known_users"]}
+    return len(user_settings) + len(known_users)
+
+
+def _load_binary(path: str) -> int:
+    # Как storage.load_state: снимок отображается в память, читается только заголовок.
+    with open(path, "rb") as f:
+        snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return len(UserRegistry.from_snapshot(snapshot))
+
+
+def _best_of(func, path: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def run_size(count: int, repeat: int) -> Dict[str, float]:
+    user_settings, known_users = generate_users(count)
+
+    registry = UserRegistry()
+    for chat_id, settings in user_settings.items():
+        registry.apply(chat_id, settings, True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "users.json")
+        bin_path = os.path.join(tmp, "users.bin")
+        _write_json(json_path, user_settings, known_users)
+        with open(bin_path, "wb") as f:
+            f.write(registry.to_snapshot())
+
+        results = {
+            "json_mb": os.path.getsize(json_path) / 1_000_000,
+            "bin_mb": os.path.getsize(bin_path) / 1_000_000,
+            "json_load_ms": _best_of(_load_json, json_path, repeat),
+            "bin_load_ms": _best_of(_load_binary, bin_path, repeat),
+        }
+
+        # Первое обращение к пользователю: бинарный поиск и декодирование записи.
+        with open(bin_path, "rb") as f:
+            loaded = UserRegistry.from_snapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        sample = random.Random(2).sample(sorted(user_settings), 1000)
+        start = time.perf_counter()
+        for chat_id in sample:
+            loaded.get(chat_id)
+        results["first_lookup_us"] = (time.perf_counter() - start) / len(sample) * 1_000_000
+
+        assert all(loaded.get(chat_id).to_dict() == user_settings[chat_id] for chat_id in sample), \
+            "снимок и исходные данные разошлись"
+
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Загрузка снимка пользователей: users.bin против json")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-speedup", type=float, default=DEFAULT_MIN_SPEEDUP)
+    args = parser.parse_args(argv)
+
+    failed: List[str] = []
+    for size in args.sizes:
+        print(f"== {size}: {SIZES[size]} пользователей")
+        results = run_size(SIZES[size], args.repeat)
+        speedup = results["json_load_ms"] / results["bin_load_ms"]
+
+        print(f"  размер          json {results['json_mb']:.1f} МБ, bin {results['bin_mb']:.1f} МБ")
+        print(f"  загрузка json   {results['json_load_ms']:>10.1f} мс")
+        print(f"  загрузка bin    {results['bin_load_ms']:>10.1f} мс   x{speedup:.1f} быстрее")
+        print(f"  первый get      {results['first_lookup_us']:>10.2f} мкс")
+
+        if speedup < args.min_speedup:
+            failed.append(size)
+
+    if failed:
+        print(f"Ускорение меньше x{args.min_speedup}: {', '.join(failed)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import csv
+import io
+import random
+from typing import List
+
+from config import DAY_NAMES
+
+SUBJECTS = [
+    "Алгебра",
+    "Геометрия",
+    "Русский язык",
+    "Литература",
+    "Английский язык",
+    "История",
+    "Обществознание",
+    "Физика",
+    "Химия",
+    "Биология",
+    "География",
+    "Информатика",
+    "Физкультура",
+    "Экономика",
+]
+
+TEACHERS = [
+    "Иванова И.И.",
+    "Петров П.П.",
+    "Сидорова А.В.",
+    "Кузнецов Д.С.",
+    "Смирнова Е.А.",
+    "Попов В.Н.",
+]
+
+VARIANT_PREFIXES = ["соц-эк", "эконом", "эн", "фил", "эко", "мат", "био"]
+
+# Звонки: 8:30, урок 45 минут, перемена 10 минут.
+FIRST_LESSON_START = 8 * 60 + 30
+LESSON_LENGTH = 45
+BREAK_LENGTH = 10
+
+
+def make_variants(count: int) -> List[str]:
+    # "соц-эк 1", "эконом 1", ..., "соц-эк 2", ...
+    return [
+        f"{VARIANT_PREFIXES[i % len(VARIANT_PREFIXES)]} {i // len(VARIANT_PREFIXES) + 1}"
+        for i in range(count)
+    ]
+
+
+def _lesson_time(number: int) -> str:
+    start = FIRST_LESSON_START + (number - 1) * (LESSON_LENGTH + BREAK_LENGTH)
+    end = start + LESSON_LENGTH
+    return f"{start // 60}:{start % 60:02d}-{end // 60}:{end % 60:02d}"
+
+
+def generate_sheet_csv(
+    parallels: int,
+    variants: int,
+    lessons_per_day: int = 7,
+    free_ratio: float = 0.1,
+    seed: int = 0,
+) -> str:
+    # CSV в том же виде, что экспорт Google Sheets: заголовок блока,
+    # строка «№ урока» с днями, уроки с номером и временем в одной ячейке.
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    for parallel in range(5, 5 + parallels):
+        for variant in make_variants(variants):
+            writer.writerow(["", f"Расписание {parallel} {variant} класса", "", "", "", ""])
+            writer.writerow(["№ урока\nвремя", *DAY_NAMES])
+
+            for number in range(1, lessons_per_day + 1):
+                row = [f"{number}\n{_lesson_time(number)}"]
+                for _ in DAY_NAMES:
+                    if rnd.random() < free_ratio:
+                        row.append("")
+                        continue
+                    subject = rnd.choice(SUBJECTS)
+                    teacher = rnd.choice(TEACHERS)
+                    room = rnd.randint(100, 420)
+                    row.append(f"{subject}\n{teacher}\nкаб. {room}")
+                writer.writerow(row)
+
+            writer.writerow([])
+
+    return out.getvalue()
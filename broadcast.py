@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from config import (
+    BROADCAST_CHECKPOINT_INTERVAL,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_RATE,
+    BROADCAST_WORKERS,
+)
+from loader import bot
+from state import load_user, mark_dirty
+from storage import append_broadcast_done, clear_broadcast, load_broadcast, save_broadcast
+
+logger = logging.getLogger(__name__)
+
+# Исходы доставки (так же пишутся в broadcast.done)
+SENT = "sent"
+FAILED = "failed"
+PRUNED = "pruned"
+
+
+class TokenBucket:
+    # Общий лимит отправки: rate сообщений в секунду, всплеск до capacity.
+    # После RetryAfter от Telegram ждут все, а не только получивший ошибку воркер.
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Без всплесков: лимит Telegram считается по секундам, а не в среднем.
+send_bucket = TokenBucket(BROADCAST_RATE, capacity=1)
+
+
+@dataclass
+class BroadcastJob:
+    text: str
+    admin_chat_id: int
+    total: int
+    started_at: datetime = field(default_factory=datetime.now)
+    sent: int = 0
+    failed: int = 0
+    pruned: int = 0
+    # Обработаны до перезапуска (для скорости и оценки времени)
+    resumed: int = 0
+    cancelled: bool = False
+    # Исходы, ещё не записанные в broadcast.done
+    unsaved: List[Tuple[int, str]] = field(default_factory=list)
+    started_monotonic: float = field(default_factory=time.monotonic)
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.pruned
+
+    def record(self, chat_id: int, outcome: str) -> None:
+        if outcome == SENT:
+            self.sent += 1
+        elif outcome == PRUNED:
+            self.pruned += 1
+        else:
+            self.failed += 1
+        self.unsaved.append((chat_id, outcome))
+
+    def progress_text(self) -> str:
+        elapsed = max(time.monotonic() - self.started_monotonic, 1e-6)
+        rate = (self.done - self.resumed) / elapsed
+        left = self.total - self.done
+        eta = f"{int(left / rate)} с" if rate > 0 else "—"
+        return (
+            f"Рассылка от {self.started_at:%d.%m %H:%M}: {self.done} из {self.total}\n"
+            f"Доставлено: {self.sent}, ошибок: {self.failed}, "
+            f"удалено недоступных чатов: {self.pruned}\n"
+            f"Скорость: {rate:.1f} сообщ./с, осталось примерно {eta}"
+        )
+
+
+_job: Optional[BroadcastJob] = None
+_task: Optional["asyncio.Task[None]"] = None
+
+
+def get_broadcast() -> Optional[BroadcastJob]:
+    return _job if _task is not None and not _task.done() else None
+
+
+async def deliver(chat_id: int, text: str) -> str:
+    # Одно сообщение с общим лимитом: ждёт RetryAfter, повторяет сетевые ошибки.
+    # Используется и рассылкой, и уведомлениями об изменениях расписания.
+    attempt = 0
+    while True:
+        await send_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return SENT
+        except TelegramRetryAfter as e:
+            # Не считается попыткой: Telegram сам сказал, сколько ждать.
+            logger.warning("Рассылка: Telegram просит подождать %s с", e.retry_after)
+            send_bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramNotFound):
+            return PRUNED
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                return PRUNED
+            logger.warning("Рассылка: не удалось отправить %s: %s", chat_id, e)
+            return FAILED
+        except (TelegramNetworkError, TelegramServerError) as e:
+            attempt += 1
+            if attempt > BROADCAST_MAX_RETRIES:
+                logger.warning("Рассылка: %s недоступен после %d попыток: %s", chat_id, attempt, e)
+                return FAILED
+            await asyncio.sleep(min(2 ** attempt, 30))
+        except Exception as e:
+            logger.warning("Рассылка: не удалось отправить %s: %s", chat_id, e)
+            return FAILED
+
+
+async def prune_chat(chat_id: int) -> None:
+    # Бот заблокирован или чата больше нет — больше не считаем его получателем.
+    record = await load_user(chat_id)
+    if record is not None and record.known:
+        record.known = False
+        mark_dirty(chat_id)
+
+
+async def _worker(job: BroadcastJob, queue: "asyncio.Queue[int]") -> None:
+    while not job.cancelled:
+        try:
+            chat_id = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        outcome = await deliver(chat_id, job.text)
+        if outcome == PRUNED:
+            await prune_chat(chat_id)
+        job.record(chat_id, outcome)
+
+
+async def _save_progress(job: BroadcastJob) -> None:
+    if not job.unsaved:
+        return
+    entries, job.unsaved = job.unsaved, []
+    await asyncio.to_thread(append_broadcast_done, entries)
+
+
+async def _checkpoint_loop(job: BroadcastJob) -> None:
+    while True:
+        await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+        try:
+            await _save_progress(job)
+        except Exception as e:
+            logger.exception("Рассылка: не удалось сохранить прогресс: %s", e)
+
+
+async def _run(job: BroadcastJob, pending: List[int]) -> None:
+    queue: "asyncio.Queue[int]" = asyncio.Queue()
+    for chat_id in pending:
+        queue.put_nowait(chat_id)
+
+    checkpoint = asyncio.create_task(_checkpoint_loop(job))
+    try:
+        await asyncio.gather(*(
+            _worker(job, queue) for _ in range(min(BROADCAST_WORKERS, len(pending)) or 1)
+        ))
+    finally:
+        # Остановка бота: сохраняем прогресс, рассылка продолжится после запуска.
+        checkpoint.cancel()
+        await _save_progress(job)
+
+    await asyncio.to_thread(clear_broadcast)
+
+    status = "остановлена" if job.cancelled else "завершена"
+    logger.info("Рассылка %s: %d из %d", status, job.done, job.total)
+    try:
+        await bot.send_message(job.admin_chat_id, f"Рассылка {status}.\n{job.progress_text()}")
+    except Exception as e:
+        logger.warning("Не удалось отправить итог рассылки админу: %s", e)
+
+
+def _launch(job: BroadcastJob, pending: List[int]) -> BroadcastJob:
+    global _job, _task
+
+    _job = job
+    _task = asyncio.create_task(_run(job, pending))
+    return job
+
+
+async def start_broadcast(
+    text: str,
+    admin_chat_id: int,
+    recipients: List[int],
+) -> Optional[BroadcastJob]:
+    # None — если другая рассылка ещё идёт.
+    if get_broadcast() is not None:
+        return None
+
+    recipients = sorted(recipients)
+    job = BroadcastJob(text=text, admin_chat_id=admin_chat_id, total=len(recipients))
+    await asyncio.to_thread(save_broadcast, {
+        "text": text,
+        "admin_chat_id": admin_chat_id,
+        "started_at": job.started_at.isoformat(),
+        "recipients": recipients,
+    })
+    logger.info("Рассылка запущена: %d получателей", job.total)
+    return _launch(job, recipients)
+
+
+def resume_broadcast() -> Optional[BroadcastJob]:
+    # Продолжить рассылку, прерванную остановкой бота.
+    # Повторно могут получить сообщение только чаты из последних
+    # BROADCAST_CHECKPOINT_INTERVAL секунд перед остановкой.
+    saved = load_broadcast()
+    if saved is None or get_broadcast() is not None:
+        return None
+
+    data, done = saved
+    recipients = data.get("recipients", [])
+    job = BroadcastJob(
+        text=data["text"],
+        admin_chat_id=data["admin_chat_id"],
+        total=len(recipients),
+        started_at=datetime.fromisoformat(data["started_at"]),
+    )
+    outcomes: Dict[str, int] = {}
+    for outcome in done.values():
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    job.sent = outcomes.get(SENT, 0)
+    job.pruned = outcomes.get(PRUNED, 0)
+    job.failed = len(done) - job.sent - job.pruned
+    job.resumed = len(done)
+
+    pending = [chat_id for chat_id in recipients if chat_id not in done]
+    logger.info("Рассылка продолжается: осталось %d из %d", len(pending), job.total)
+    return _launch(job, pending)
+
+
+def cancel_broadcast() -> bool:
+    job = get_broadcast()
+    if job is None:
+        return False
+    job.cancelled = True
+    return True
+
+
+async def stop_broadcast() -> None:
+    # При остановке бота: воркеры прерываются, прогресс остаётся на диске.
+    global _task
+
+    if _task is None or _task.done():
+        return
+
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+
+from config import CLASS_VARIANTS_BY_PARALLEL, PARALLELS
+
+
+@dataclass(frozen=True)
+class ClassCatalog:
+    # Какие классы есть: параллели по порядку и их варианты (профили).
+    parallels: Tuple[str, ...]
+    variants_by_parallel: Dict[str, Tuple[str, ...]]
+    # Множества для фильтров хендлеров: проверка за O(1).
+    parallel_set: FrozenSet[str]
+    variant_set: FrozenSet[str]
+    class_set: FrozenSet[Tuple[str, str]]
+
+    def has_parallel(self, parallel: str) -> bool:
+        return parallel in self.variants_by_parallel
+
+    def has_class(self, parallel: str, variant: str) -> bool:
+        return (parallel, variant) in self.class_set
+
+
+def _parallel_sort_key(parallel: str) -> Tuple[int, str]:
+    return (int(parallel), parallel) if parallel.isdigit() else (10 ** 6, parallel)
+
+
+def build_catalog(classes: Iterable[Tuple[str, str]], parallels: Iterable[str] = ()) -> ClassCatalog:
+    # classes — пары (параллель, вариант) в порядке появления в таблице.
+    # parallels — параллели, которые показываем даже без вариантов.
+    variants: Dict[str, Dict[str, None]] = {}
+    for parallel, variant in classes:
+        variants.setdefault(parallel, {})[variant] = None
+
+    all_parallels = set(parallels) | set(variants)
+    variants_by_parallel = {p: tuple(v) for p, v in variants.items()}
+
+    return ClassCatalog(
+        parallels=tuple(sorted(all_parallels, key=_parallel_sort_key)),
+        variants_by_parallel=variants_by_parallel,
+        parallel_set=frozenset(all_parallels),
+        variant_set=frozenset(v for vs in variants_by_parallel.values() for v in vs),
+        class_set=frozenset(
+            (p, v) for p, vs in variants_by_parallel.items() for v in vs
+        ),
+    )
+
+
+# Пока таблица не скачана, используем классы из config.
+_catalog = build_catalog(
+    ((p, v) for p, vs in CLASS_VARIANTS_BY_PARALLEL.items() for v in vs),
+    PARALLELS,
+)
+
+
+def get_catalog() -> ClassCatalog:
+    return _catalog
+
+
+def update_catalog(classes: Iterable[Tuple[str, str]]) -> Optional[ClassCatalog]:
+    # Подменяем каталог классами из таблицы. Возвращает новый каталог,
+    # если он отличается от текущего, иначе None.
+    global _catalog
+
+    catalog = build_catalog(classes)
+    if not catalog.class_set or catalog == _catalog:
+        return None
+
+    _catalog = catalog
+    return catalog
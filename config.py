@@ -19,6 +19,14 @@ SHEET_CSV_URL = (
     "17iHtFw9e_IsKDDksdv4fAbIuOuLkLPxVeYlyi6Db_lY/export?format=csv&gid=1405588358"
 )
 
+# Таблица (лист, gid) с расписанием каждой параллели. Таблицы скачиваются
+# параллельно и кэшируются отдельно; одна таблица может быть у нескольких параллелей.
+SHEET_CSV_URLS_BY_PARALLEL = {
+    "5": SHEET_CSV_URL,
+}
+
+# Классы до первой загрузки таблицы. Потом каталог берётся из заголовков
+# «Расписание N X класса» (см. catalog.py).
 PARALLELS = ["5", "6", "7", "8", "9", "10", "11"]
 
 CLASS_VARIANTS_BY_PARALLEL = {
@@ -39,9 +47,23 @@ CLASS_VARIANTS_BY_PARALLEL = {
     ],
 }
 
-ALL_VARIANTS = sorted(
-    {variant for variants in CLASS_VARIANTS_BY_PARALLEL.values() for variant in variants}
-)
+# Где хранить пользователей: "json" (файлы: снимок users.bin + журнал) или "sqlite"
+USER_STORE_BACKEND = os.getenv("USER_STORE_BACKEND", "json")
+
+# Отложенная запись пользователей: раз в столько миллисекунд
+# или сразу, как только накопилось столько изменённых чатов
+USER_FLUSH_INTERVAL_MS = 500
+USER_FLUSH_MAX_PENDING = 200
+
+# Сколько недавно активных пользователей держать в памяти декодированными
+# (остальные читаются из снимка users.bin при обращении)
+USER_CACHE_SIZE = 10000
+
+# FSM-состояния (data/fsm.sqlite3): сколько держать в памяти, как часто писать
+# на диск и через сколько секунд без изменений считать состояние брошенным
+FSM_CACHE_SIZE = 10000
+FSM_FLUSH_INTERVAL_MS = 500
+FSM_STATE_TTL = 7 * 24 * 60 * 60
 
 MAX_MESSAGE_LENGTH = 4000
 
@@ -49,6 +71,35 @@ DAY_NAMES = ["Понедельник", "Вторник", "Среда", "Четв
 
 SCHEDULE_CACHE_TTL = 300
 
+# Фоновое обновление расписания раньше, чем истечёт TTL
+SCHEDULE_REFRESH_INTERVAL = 240
+
+# Сколько секунд можно отдавать устаревший кэш, если Google недоступен
+SCHEDULE_STALE_MAX_AGE = 6 * 60 * 60
+
+# Разбор CSV вне event loop: число воркеров и пул процессов вместо потоков
+# (имеет смысл для очень больших таблиц)
+SCHEDULE_PARSE_WORKERS = 2
+SCHEDULE_PARSE_USE_PROCESSES = False
+
+# HTTP-сессия для скачивания расписания (секунды)
+SCHEDULE_HTTP_CONNECT_TIMEOUT = 5.0
+SCHEDULE_HTTP_READ_TIMEOUT = 15.0
+SCHEDULE_HTTP_TOTAL_TIMEOUT = 30.0
+SCHEDULE_HTTP_POOL_SIZE = 10
+SCHEDULE_HTTP_DNS_CACHE_TTL = 600
+
+# Рассылка: не больше BROADCAST_RATE сообщений в секунду на всех воркеров
+# (лимит Telegram — около 30), повторы при сетевых ошибках и как часто
+# сохранять прогресс для продолжения после перезапуска (секунды)
+BROADCAST_RATE = 25
+BROADCAST_WORKERS = 8
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_CHECKPOINT_INTERVAL = 1.0
+
+# Сколько секунд Telegram может кэшировать ответы inline-режима
+INLINE_CACHE_TIME = 300
+
 ADMIN_IDS = [
     123456789,  # Поменять на id админа
 ]
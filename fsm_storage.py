@@ -0,0 +1,254 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class FsmRecord:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None, updated_at: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated_at = updated_at
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SqliteFsmStorage(BaseStorage):
+    # FSM-состояния в SQLite, чтобы перезапуск не сбрасывал регистрацию и выбор класса.
+    # Чтение идёт из LRU-кэша в памяти; запись — в кэш сразу, на диск пачкой
+    # раз в flush_interval. Состояния, не менявшиеся дольше ttl, удаляются.
+
+    _UPSERT_SQL = (
+        "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET "
+        "state = excluded.state, data = excluded.data, updated_at = excluded.updated_at"
+    )
+
+    def __init__(
+        self,
+        path: str = storage.FSM_DB_FILE,
+        cache_size: int = 10000,
+        ttl: float = 7 * 24 * 60 * 60,
+        flush_interval: float = 0.5,
+        sweep_interval: float = 60 * 60,
+    ):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True,
+            with_business_connection_id=True,
+            with_destiny=True,
+        )
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Соединение используется только потоком _executor.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, "
+            "state TEXT, "
+            "data TEXT NOT NULL DEFAULT '{}', "
+            "updated_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fsm_by_age ON fsm (updated_at)")
+        self.conn.commit()
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-store")
+        self._cache: "OrderedDict[str, FsmRecord]" = OrderedDict()
+        # Изменения, ещё не записанные на диск: ключ -> запись (None — удалить).
+        # Кэш может вытеснить запись раньше записи, поэтому читаем и отсюда.
+        self._pending: Dict[str, Optional[Tuple[Optional[str], str, float]]] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._tasks: list = []
+        self._closed = False
+
+    # Кэш
+
+    def _expired(self, record: FsmRecord, now: float) -> bool:
+        return not record.is_empty() and now - record.updated_at > self.ttl
+
+    def _remember(self, key: str, record: FsmRecord) -> None:
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load_row(self, key: str) -> Optional[Tuple[Optional[str], str, float]]:
+        return self.conn.execute(
+            "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+
+    async def _get_record(self, key: StorageKey) -> Tuple[str, FsmRecord]:
+        str_key = self.key_builder.build(key)
+        now = time.time()
+
+        record = self._cache.get(str_key)
+        if record is None:
+            if str_key in self._pending:
+                row = self._pending[str_key]
+            else:
+                row = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._load_row, str_key
+                )
+            if row is None:
+                record = FsmRecord()
+            else:
+                record = FsmRecord(row[0], json.loads(row[1]), row[2])
+            # Другой запрос мог успеть записать этот ключ, пока читали диск.
+            record = self._cache.get(str_key, record)
+        else:
+            self._cache.move_to_end(str_key)
+
+        if self._expired(record, now):
+            record = FsmRecord()
+            self._pending[str_key] = None
+
+        self._remember(str_key, record)
+        return str_key, record
+
+    def _mark_changed(self, str_key: str, record: FsmRecord) -> None:
+        record.updated_at = time.time()
+        if record.is_empty():
+            self._pending[str_key] = None
+        else:
+            self._pending[str_key] = (
+                record.state,
+                json.dumps(record.data, ensure_ascii=False, separators=(",", ":")),
+                record.updated_at,
+            )
+
+    # BaseStorage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        str_key, record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_changed(str_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        str_key, record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_changed(str_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._get_record(key)
+        return record.data.copy()
+
+    # Запись на диск
+
+    def _write_batch(self, batch: Dict[str, Optional[Tuple[Optional[str], str, float]]]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM fsm WHERE key = ?",
+                ((key,) for key, row in batch.items() if row is None),
+            )
+            self.conn.executemany(
+                self._UPSERT_SQL,
+                ((key, *row) for key, row in batch.items() if row is not None),
+            )
+
+    async def flush(self) -> None:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            batch = self._pending
+            self._pending = {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._write_batch, batch
+                )
+            except Exception as e:
+                # Более свежие изменения, пришедшие во время записи, важнее.
+                for str_key, row in batch.items():
+                    self._pending.setdefault(str_key, row)
+                logger.exception("Ошибка записи FSM-состояний: %s", e)
+
+    def _delete_expired(self, deadline: float) -> int:
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM fsm WHERE updated_at < ?", (deadline,)
+            ).rowcount
+
+    async def sweep(self) -> None:
+        # Удалить брошенные состояния из памяти и с диска.
+        await self.flush()
+        now = time.time()
+        for str_key in [k for k, record in self._cache.items() if self._expired(record, now)]:
+            del self._cache[str_key]
+
+        removed = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._delete_expired, now - self.ttl
+        )
+        if removed:
+            logger.info("Удалено устаревших FSM-состояний: %s", removed)
+
+    async def _flusher_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _sweeper_loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.exception("Ошибка очистки FSM-состояний: %s", e)
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._flusher_loop()),
+                asyncio.create_task(self._sweeper_loop()),
+            ]
+
+    async def close(self) -> None:
+        # Может вызываться повторно: Dispatcher закрывает хранилище при остановке сам.
+        if self._closed:
+            return
+        self._closed = True
+
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.conn.close)
+        self._executor.shutdown(wait=True)
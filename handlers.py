@@ -1,3 +1,4 @@
+import html
 import logging
 
 from aiogram import F
@@ -5,31 +6,49 @@ from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
-from config import ALL_VARIANTS, CLASS_VARIANTS_BY_PARALLEL, PARALLELS
+from broadcast import cancel_broadcast, get_broadcast, start_broadcast
+from catalog import get_catalog
 from keyboards import (
     make_class_keyboard,
     make_main_menu,
     make_parallel_keyboard,
     make_return_to_my_schedule_keyboard,
 )
-from loader import bot, dp
+from loader import dp
+from middlewares import flood_stats
 from shedule import (
+    get_cache_stats,
     get_class_schedule,
+    get_current_minute,
+    get_schedule_index,
     get_today_day_name,
     get_tomorrow_day_name,
     render_day_schedule,
+    refresh_now,
     render_full_schedule,
-    reset_cache,
+    render_now,
+    render_search_results,
+    search_lessons,
 )
-from state import UserStates, known_users, user_settings, save_state
+from state import UserStates, class_records, flush_stats, known_ids, mark_dirty, mark_known, users
 from utils import is_admin, send_long_text, get_free_time_text
 
 logger = logging.getLogger(__name__)
 
+
+def _is_parallel_text(message: Message) -> bool:
+    # Каталог может смениться после обновления таблицы, поэтому проверяем на лету.
+    return message.text in get_catalog().parallel_set
+
+
+def _is_variant_text(message: Message) -> bool:
+    return message.text in get_catalog().variant_set
+
+
 async def _ensure_registered(message: Message, state: FSMContext):
     # Проверяем, что у пользователя есть имя и фамилия.
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     if settings.get("first_name") and settings.get("last_name"):
         return True, settings
@@ -50,7 +69,7 @@ async def _ensure_registered(message: Message, state: FSMContext):
     if suggested_first:
         text += f"\n(Можно просто отправить: <code>{suggested_first}</code>)"
 
-    save_state()
+    mark_dirty(chat_id)
     await message.answer(text)
     return False, settings
 
@@ -80,8 +99,8 @@ async def _ensure_my_class(message: Message, state: FSMContext):
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext) -> None:
     chat_id = message.chat.id
-    known_users.add(chat_id)
-    settings = user_settings.setdefault(chat_id, {})
+    mark_known(chat_id)
+    settings = users.ensure(chat_id)
 
     if not settings.get("first_name") or not settings.get("last_name"):
         await state.set_state(UserStates.registering_name)
@@ -94,7 +113,7 @@ async def cmd_start(message: Message, state: FSMContext) -> None:
         if suggested_first:
             text += f"\n(Можешь просто отправить: <code>{suggested_first}</code>)"
 
-        save_state()
+        mark_dirty(chat_id)
         await message.answer(text)
         return
 
@@ -102,7 +121,7 @@ async def cmd_start(message: Message, state: FSMContext) -> None:
 
     settings.pop("parallel", None)
     settings.pop("variant", None)
-    save_state()
+    mark_dirty(chat_id)
 
     await message.answer(
         f"Привет, {settings.get('first_name', '')}! "
@@ -115,7 +134,7 @@ async def cmd_start(message: Message, state: FSMContext) -> None:
 @dp.message(UserStates.registering_name)
 async def handle_register_name(message: Message, state: FSMContext) -> None:
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     first_name = message.text.strip()
     if not first_name:
@@ -123,7 +142,7 @@ async def handle_register_name(message: Message, state: FSMContext) -> None:
         return
 
     settings["first_name"] = first_name
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.registering_surname)
 
@@ -138,7 +157,7 @@ async def handle_register_name(message: Message, state: FSMContext) -> None:
 @dp.message(UserStates.registering_surname)
 async def handle_register_surname(message: Message, state: FSMContext) -> None:
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     last_name = message.text.strip()
     if not last_name:
@@ -146,7 +165,7 @@ async def handle_register_surname(message: Message, state: FSMContext) -> None:
         return
 
     settings["last_name"] = last_name
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.choosing_my_class)
 
@@ -160,7 +179,7 @@ async def handle_register_surname(message: Message, state: FSMContext) -> None:
 @dp.message(Command("register"))
 async def cmd_register(message: Message, state: FSMContext) -> None:
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     await state.set_state(UserStates.registering_name)
 
@@ -172,7 +191,7 @@ async def cmd_register(message: Message, state: FSMContext) -> None:
     if suggested_first:
         text += f"\n(Можешь просто отправить: <code>{suggested_first}</code>)"
 
-    save_state()
+    mark_dirty(chat_id)
     await message.answer(text)
 
 
@@ -181,12 +200,18 @@ async def cmd_help(message: Message) -> None:
     await message.answer(
         "<b>Что я умею:</b>\n"
         "• Показывать расписание на сегодня / завтра / всю неделю\n"
+        "• Подсказывать, какой урок идёт сейчас и какой следующий (/now)\n"
+        "• Искать предмет, учителя или кабинет по всем классам "
+        "(/find алгебра четверг, /find физика 3)\n"
         "• Давать расписание другого класса\n"
-        "• Сохранять твой класс и профиль\n\n"
+        "• Сохранять твой класс и профиль\n"
+        "• Присылать уведомления, когда меняется расписание твоего класса "
+        "(/notify — включить/выключить)\n\n"
         "Сначала нужно зарегистрироваться (имя и фамилия), "
         "а потом выбрать свой класс через /start.\n\n"
         "Основные кнопки внизу:\n"
         "📅 На сегодня / 📅 На завтра / 📅 На неделю\n"
+        "⏰ Сейчас — текущий и следующий урок\n"
         "👀 Расписание другого класса — посмотреть чужой класс\n"
         "🔁 Сменить класс — выбрать свой заново"
     )
@@ -195,7 +220,7 @@ async def cmd_help(message: Message) -> None:
 @dp.message(Command("profile"))
 async def cmd_profile(message: Message) -> None:
     chat_id = message.chat.id
-    settings = user_settings.get(chat_id, {})
+    settings = users.get(chat_id, {})
 
     first_name = settings.get("first_name")
     last_name = settings.get("last_name")
@@ -228,15 +253,66 @@ async def cmd_profile(message: Message) -> None:
             f"<b>{other_parallel} {other_variant}</b>"
         )
 
+    if settings.get("notify_changes", True):
+        lines.append("Уведомления об изменениях: включены")
+    else:
+        lines.append("Уведомления об изменениях: выключены")
+
     lines.append(
         "\nКоманды:\n"
         "• /register — изменить имя и фамилию\n"
-        "• /start — выбрать класс заново"
+        "• /start — выбрать класс заново\n"
+        "• /notify — включить/выключить уведомления"
     )
 
     await message.answer("\n".join(lines))
 
 
+@dp.message(Command("find"))
+async def cmd_find(message: Message) -> None:
+    _, _, query = message.text.partition(" ")
+    query = query.strip()
+    if not query:
+        await message.answer(
+            "Напиши, что искать: предмет, учителя или кабинет.\n"
+            "Можно добавить день и номер урока, например:\n"
+            "<code>/find алгебра четверг</code>\n"
+            "<code>/find физика 3</code>"
+        )
+        return
+
+    index = await get_schedule_index()
+    if index is None:
+        await message.answer("Не получилось получить данные с Google Sheets.")
+        return
+
+    hits = search_lessons(index, query)
+    if not hits:
+        await message.answer(f"По запросу «{html.escape(query)}» ничего не нашлось.")
+        return
+
+    await send_long_text(message, render_search_results(hits))
+
+
+@dp.message(Command("notify"))
+async def cmd_notify(message: Message) -> None:
+    chat_id = message.chat.id
+    settings = users.ensure(chat_id)
+
+    enabled = not settings.get("notify_changes", True)
+    settings["notify_changes"] = enabled
+    mark_dirty(chat_id)
+
+    if enabled:
+        await message.answer(
+            "Уведомления включены: я напишу, когда изменится расписание твоего класса."
+        )
+    else:
+        await message.answer(
+            "Уведомления выключены. Включить снова: /notify"
+        )
+
+
 # Админские команды
 
 @dp.message(Command("admin"))
@@ -247,8 +323,13 @@ async def cmd_admin(message: Message) -> None:
 
     await message.answer(
         "<b>Админ-команды:</b>\n"
-        "/reload_schedule — сброс кэша расписания (CSV)\n"
-        "/broadcast текст — разослать сообщение всем пользователям"
+        "/reload_schedule — обновить расписание (CSV) прямо сейчас\n"
+        "/reload_schedule full — скачать и разобрать заново, даже если таблица не менялась\n"
+        "/stats — состояние кэша расписания, записи пользователей и антифлуда\n"
+        "/broadcast текст — разослать сообщение всем пользователям\n"
+        "/broadcast_class 5 эконом 2 текст — рассылка одному классу\n"
+        "/broadcast_status — ход текущей рассылки\n"
+        "/broadcast_cancel — остановить рассылку"
     )
 
 
@@ -258,8 +339,43 @@ async def cmd_reload_schedule(message: Message) -> None:
         await message.answer("Эта команда только для админов.")
         return
 
-    reset_cache()
-    await message.answer("Кэш расписания сброшен.")
+    _, _, mode = message.text.partition(" ")
+    if await refresh_now(force=mode.strip().lower() == "full"):
+        await message.answer("Расписание обновлено.")
+    else:
+        await message.answer(
+            "Не удалось обновить расписание с Google Sheets, пока используется кэш."
+        )
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда только для админов.")
+        return
+
+    cache = get_cache_stats()
+    memory = users.memory_stats()
+    known_count = len(await known_ids())
+    await message.answer(
+        "<b>Расписание:</b>\n"
+        f"Таблиц в кэше: {cache['sheets_cached']} из {cache['sheets']}, "
+        f"возраст до {cache['max_age_seconds']} с\n"
+        f"Запросов дождались общего обновления: {cache['coalesced_requests']}\n\n"
+        "<b>Пользователи:</b>\n"
+        f"Всего: {len(users)}, известных чатов: {known_count}\n"
+        f"В памяти: {memory['hot']} в кэше, {memory['changed']} изменённых "
+        f"(в снимке {memory['snapshot']})\n"
+        f"Ждут записи: {flush_stats.pending}\n"
+        f"Записей пачками: {flush_stats.flushes} ({flush_stats.users_written} польз.), "
+        f"ошибок: {flush_stats.errors}\n"
+        f"Время записи: последняя {flush_stats.last_latency_ms:.1f} мс, "
+        f"макс. {flush_stats.max_latency_ms:.1f} мс\n\n"
+        "<b>Антифлуд:</b>\n"
+        f"Отслеживается пользователей: {flood_stats.tracked_users}, "
+        f"удалено неактивных: {flood_stats.evicted}\n"
+        f"Блокировок: {flood_stats.blocks}, отброшено сообщений: {flood_stats.blocked_messages}"
+    )
 
 
 @dp.message(Command("broadcast"))
@@ -274,28 +390,98 @@ async def cmd_broadcast(message: Message) -> None:
         await message.answer("Нужно указать текст рассылки: /broadcast твой текст")
         return
 
-    if not known_users:
+    recipients = await known_ids()
+    if not recipients:
         await message.answer("Пока что нет пользователей для рассылки.")
         return
 
-    sent = 0
-    for user_id in list(known_users):
-        try:
-            await bot.send_message(user_id, text)
-            sent += 1
-        except Exception as e:
-            logger.warning("Не удалось отправить сообщение %s: %s", user_id, e)
+    await _start_broadcast(message, text, recipients)
+
+
+async def _start_broadcast(message: Message, text: str, recipients) -> None:
+    job = await start_broadcast(text, message.chat.id, recipients)
+    if job is None:
+        await message.answer("Предыдущая рассылка ещё идёт: /broadcast_status")
+        return
+
+    await message.answer(
+        f"Рассылка запущена, получателей: {job.total}.\n"
+        "Ход рассылки: /broadcast_status, остановить: /broadcast_cancel"
+    )
+
 
-    await message.answer(f"Рассылка завершена, отправлено {sent} пользователям.")
+def _parse_class_broadcast(args: str):
+    # "5 эконом 2 текст" -> ("5", "эконом 2", "текст"). Название класса может
+    # содержать пробелы, поэтому сверяемся с каталогом: подходит самое длинное.
+    parallel, _, rest = args.strip().partition(" ")
+    rest = rest.strip()
+    variants = get_catalog().variants_by_parallel.get(parallel, ())
+    for variant in sorted(variants, key=len, reverse=True):
+        head = rest[:len(variant)]
+        tail = rest[len(variant):]
+        if head.casefold() == variant.casefold() and (not tail or tail[0].isspace()):
+            return parallel, variant, tail.strip()
+    return parallel, None, ""
+
+
+@dp.message(Command("broadcast_class"))
+async def cmd_broadcast_class(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда только для админов.")
+        return
+
+    _, _, args = message.text.partition(" ")
+    parallel, variant, text = _parse_class_broadcast(args)
+    if variant is None or not text:
+        await message.answer(
+            "Нужно указать класс и текст: /broadcast_class 5 эконом 2 твой текст"
+        )
+        return
+
+    recipients = [
+        chat_id for chat_id, record in await class_records(parallel, variant) if record.known
+    ]
+
+    if not recipients:
+        await message.answer(f"В классе {parallel} {html.escape(variant)} пока нет пользователей.")
+        return
+
+    await _start_broadcast(message, text, recipients)
+
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда только для админов.")
+        return
+
+    job = get_broadcast()
+    if job is None:
+        await message.answer("Сейчас рассылки нет.")
+        return
+
+    await message.answer(job.progress_text())
+
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда только для админов.")
+        return
+
+    if cancel_broadcast():
+        await message.answer("Рассылка останавливается, итог придёт отдельным сообщением.")
+    else:
+        await message.answer("Сейчас рассылки нет.")
 
 
 # Выбор своего класса FSM
 
-@dp.message(UserStates.choosing_my_class, F.text.in_(PARALLELS))
+@dp.message(UserStates.choosing_my_class, _is_parallel_text)
 async def handle_my_class_choice(message: Message, state: FSMContext) -> None:
     # Пользователь выбирает свой класс (цифру).
     chat_id = message.chat.id
-    known_users.add(chat_id)
+    mark_known(chat_id)
 
     is_reg, settings = await _ensure_registered(message, state)
     if not is_reg:
@@ -303,14 +489,14 @@ async def handle_my_class_choice(message: Message, state: FSMContext) -> None:
 
     class_number = message.text.strip()
 
-    if class_number not in CLASS_VARIANTS_BY_PARALLEL:
+    if not get_catalog().has_parallel(class_number):
         await message.answer(
             f"Для класса {class_number} пока нет настроенного расписания."
         )
         return
 
     settings["parallel"] = class_number
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.choosing_my_variant)
 
@@ -330,11 +516,11 @@ async def handle_my_class_invalid(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(UserStates.choosing_my_variant, F.text.in_(ALL_VARIANTS))
+@dp.message(UserStates.choosing_my_variant, _is_variant_text)
 async def handle_my_variant_choice(message: Message, state: FSMContext) -> None:
     # Пользователь выбирает свою параллель/профиль.
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
     variant = message.text.strip()
     parallel = settings.get("parallel")
 
@@ -347,7 +533,7 @@ async def handle_my_variant_choice(message: Message, state: FSMContext) -> None:
         )
         return
 
-    if variant not in CLASS_VARIANTS_BY_PARALLEL.get(parallel, []):
+    if not get_catalog().has_class(parallel, variant):
         await message.answer(
             f"В классе {parallel} нет параллели/профиля «{variant}».\n"
             "Выбери один из вариантов на клавиатуре."
@@ -355,7 +541,7 @@ async def handle_my_variant_choice(message: Message, state: FSMContext) -> None:
         return
 
     settings["variant"] = variant
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.idle)
 
@@ -388,7 +574,7 @@ async def start_other_class_selection(message: Message, state: FSMContext) -> No
         return
 
     chat_id = message.chat.id
-    known_users.add(chat_id)
+    mark_known(chat_id)
 
     await state.set_state(UserStates.choosing_other_class)
     await message.answer(
@@ -397,16 +583,16 @@ async def start_other_class_selection(message: Message, state: FSMContext) -> No
     )
 
 
-@dp.message(UserStates.choosing_other_class, F.text.in_(PARALLELS))
+@dp.message(UserStates.choosing_other_class, _is_parallel_text)
 async def handle_other_class_choice(message: Message, state: FSMContext) -> None:
     # Выбираем КЛАСС для чужого расписания.
     chat_id = message.chat.id
     class_number = message.text.strip()
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     has_my_class = "parallel" in settings and "variant" in settings
 
-    if class_number not in CLASS_VARIANTS_BY_PARALLEL:
+    if not get_catalog().has_parallel(class_number):
         if has_my_class:
             await message.answer(
                 f"Для класса {class_number} пока нет настроенного расписания.",
@@ -419,7 +605,7 @@ async def handle_other_class_choice(message: Message, state: FSMContext) -> None
         return
 
     settings["other_parallel"] = class_number
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.choosing_other_variant)
 
@@ -438,11 +624,11 @@ async def handle_other_class_invalid(message: Message, state: FSMContext) -> Non
     )
 
 
-@dp.message(UserStates.choosing_other_variant, F.text.in_(ALL_VARIANTS))
+@dp.message(UserStates.choosing_other_variant, _is_variant_text)
 async def handle_other_variant_choice(message: Message, state: FSMContext) -> None:
     # Выбираем параллель, профиль для чужого класса.
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
     variant = message.text.strip()
     other_parallel = settings.get("other_parallel")
 
@@ -456,14 +642,14 @@ async def handle_other_variant_choice(message: Message, state: FSMContext) -> No
         )
         return
 
-    if variant not in CLASS_VARIANTS_BY_PARALLEL.get(other_parallel, []):
+    if not get_catalog().has_class(other_parallel, variant):
         await message.answer(
             f"В классе {other_parallel} нет параллели/профиля «{variant}».",
             )
         return
 
     settings["other_variant"] = variant
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.idle)
 
@@ -498,7 +684,7 @@ async def handle_other_variant_invalid(message: Message, state: FSMContext) -> N
 async def back_to_my_schedule(message: Message, state: FSMContext) -> None:
     # Возврат в меню со своим классом.
     chat_id = message.chat.id
-    settings = user_settings.get(chat_id, {})
+    settings = users.get(chat_id, {})
 
     parallel = settings.get("parallel")
     variant = settings.get("variant")
@@ -587,6 +773,27 @@ async def send_my_tomorrow_schedule(message: Message, state: FSMContext) -> None
     text = render_day_schedule(schedule, day_name)
     await send_long_text(message, text)
 
+@dp.message(Command("now"))
+@dp.message(F.text == "⏰ Сейчас")
+async def send_my_current_lesson(message: Message, state: FSMContext) -> None:
+    parallel, variant, settings = await _ensure_my_class(message, state)
+    if not parallel or not variant:
+        return
+
+    schedule, error = await get_class_schedule(parallel, variant)
+    if schedule is None:
+        await message.answer(error or "Не удалось получить расписание.")
+        return
+
+    day_name = get_today_day_name()
+    if day_name is None:
+        phrase = get_free_time_text()
+        await message.answer(f"Сегодня уроков нет (выходной). {phrase}")
+        return
+
+    await message.answer(render_now(schedule, day_name, get_current_minute()))
+
+
 @dp.message(F.text == "📅 Расписание выбранного класса")
 async def send_other_selected_schedule(message: Message, state: FSMContext) -> None:
     is_reg, _ = await _ensure_registered(message, state)
@@ -594,7 +801,7 @@ async def send_other_selected_schedule(message: Message, state: FSMContext) -> N
         return
 
     chat_id = message.chat.id
-    settings = user_settings.get(chat_id, {})
+    settings = users.get(chat_id, {})
     other_parallel = settings.get("other_parallel")
     other_variant = settings.get("other_variant")
 
@@ -622,11 +829,11 @@ async def change_my_class(message: Message, state: FSMContext) -> None:
         return
 
     chat_id = message.chat.id
-    settings = user_settings.setdefault(chat_id, {})
+    settings = users.ensure(chat_id)
 
     settings.pop("parallel", None)
     settings.pop("variant", None)
-    save_state()
+    mark_dirty(chat_id)
 
     await state.set_state(UserStates.choosing_my_class)
 
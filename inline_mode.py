@@ -0,0 +1,161 @@
+import bisect
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+
+from catalog import ClassCatalog, get_catalog
+from config import INLINE_CACHE_TIME, MAX_MESSAGE_LENGTH
+from loader import dp
+from shedule import (
+    ScheduleIndex,
+    get_schedule_index,
+    get_today_day_name,
+    get_tomorrow_day_name,
+    match_day_name,
+    render_day_schedule,
+    render_full_schedule,
+)
+from state import users
+from utils import normalize_spaces
+
+logger = logging.getLogger(__name__)
+
+MAX_INLINE_RESULTS = 20
+
+_WEEK_WORDS = frozenset({"неделя", "неделю", "нед", "неделе"})
+
+# Отсортированные подписи классов каталога для поиска по префиксу.
+_labels_catalog: Optional[ClassCatalog] = None
+_labels: List[Tuple[str, Tuple[str, str]]] = []
+
+# Готовые результаты: (класс, день или "week", версия) -> статья.
+_articles: Dict[Tuple[Tuple[str, str], str, str], InlineQueryResultArticle] = {}
+_articles_version: Optional[str] = None
+
+
+def _sorted_labels() -> List[Tuple[str, Tuple[str, str]]]:
+    global _labels_catalog, _labels
+
+    catalog = get_catalog()
+    if catalog is not _labels_catalog:
+        _labels = sorted(
+            (f"{parallel} {variant}".lower(), (parallel, variant))
+            for parallel, variant in catalog.class_set
+        )
+        _labels_catalog = catalog
+    return _labels
+
+
+def _match_classes(prefix: str) -> List[Tuple[str, str]]:
+    # "5 эк" -> все классы 5 параллели с вариантом на «эк».
+    # Без номера параллели ("эконом 2") ищем по началу варианта.
+    labels = _sorted_labels()
+    i = bisect.bisect_left(labels, (prefix,))
+    found: List[Tuple[str, str]] = []
+    while i < len(labels) and labels[i][0].startswith(prefix) and len(found) < MAX_INLINE_RESULTS:
+        found.append(labels[i][1])
+        i += 1
+
+    if not found and not prefix[0].isdigit():
+        found = [
+            key
+            for label, key in labels
+            if label.split(" ", 1)[1].startswith(prefix)
+        ][:MAX_INLINE_RESULTS]
+
+    return found
+
+
+def _parse_query(query: str) -> Tuple[str, str]:
+    # "5 эконом 2 завтра" -> ("5 эконом 2", "Вторник"). Без дня — вся неделя.
+    day_key = "week"
+    class_words: List[str] = []
+
+    for word in normalize_spaces(query.lower()).split(" "):
+        if not word:
+            continue
+        if word == "сегодня":
+            day_key = get_today_day_name() or "week"
+        elif word == "завтра":
+            day_key = get_tomorrow_day_name() or "week"
+        elif word in _WEEK_WORDS:
+            day_key = "week"
+        elif not word[0].isdigit() and match_day_name(word) is not None:
+            day_key = match_day_name(word)
+        else:
+            class_words.append(word)
+
+    return " ".join(class_words), day_key
+
+
+def _get_article(index: ScheduleIndex, key: Tuple[str, str], day_key: str) -> Optional[InlineQueryResultArticle]:
+    global _articles_version
+
+    if index.version != _articles_version:
+        _articles.clear()
+        _articles_version = index.version
+
+    cache_key = (key, day_key, index.version)
+    article = _articles.get(cache_key)
+    if article is not None:
+        return article
+
+    schedule = index.classes.get(key)
+    if schedule is None:
+        return None
+
+    if day_key == "week":
+        text = render_full_schedule(schedule)
+        title = f"{schedule.label} — неделя"
+    else:
+        text = render_day_schedule(schedule, day_key)
+        title = f"{schedule.label} — {day_key.lower()}"
+
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH].rsplit("\n", 1)[0] + "\n…"
+
+    lessons = schedule.days.get(day_key, ()) if day_key != "week" else ()
+    description = ", ".join(lesson.subject.split("\n", 1)[0] for lesson in lessons[:4])
+
+    article = InlineQueryResultArticle(
+        id=hashlib.md5(repr(cache_key).encode("utf-8")).hexdigest(),
+        title=title,
+        description=description or schedule.block_title,
+        input_message_content=InputTextMessageContent(message_text=text, parse_mode="HTML"),
+    )
+    _articles[cache_key] = article
+    return article
+
+
+@dp.inline_query()
+async def inline_schedule(inline_query: InlineQuery) -> None:
+    # @bot 5 эконом 2 завтра — расписание прямо в любом чате.
+    index = await get_schedule_index()
+    if index is None:
+        await inline_query.answer([], cache_time=10, is_personal=True)
+        return
+
+    class_part, day_key = _parse_query(inline_query.query)
+
+    if class_part:
+        keys = _match_classes(class_part)
+    else:
+        # Пустой запрос — свой класс пользователя.
+        settings = users.get(inline_query.from_user.id, {})
+        parallel = settings.get("parallel")
+        variant = settings.get("variant")
+        keys = [(parallel, variant)] if parallel and variant else []
+
+    results = [
+        article
+        for article in (_get_article(index, key, day_key) for key in keys)
+        if article is not None
+    ]
+
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=not class_part,
+    )
@@ -1,19 +1,25 @@
-from typing import List
+from typing import Dict, List, Optional, Sequence
 
 from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
 
-from config import CLASS_VARIANTS_BY_PARALLEL, PARALLELS
+from catalog import ClassCatalog, get_catalog
 
+# Клавиатуры выбора класса собираются один раз на каталог и переиспользуются.
+_keyboards_catalog: Optional[ClassCatalog] = None
+_class_keyboard: Optional[ReplyKeyboardMarkup] = None
+_parallel_keyboards: Dict[str, ReplyKeyboardMarkup] = {}
 
-def make_class_keyboard() -> ReplyKeyboardMarkup:
+
+def _make_grid_keyboard(texts: Sequence[str]) -> ReplyKeyboardMarkup:
     rows: List[List[KeyboardButton]] = []
     row: List[KeyboardButton] = []
 
-    for i, p in enumerate(PARALLELS, start=1):
-        row.append(KeyboardButton(text=p))
+    for i, text in enumerate(texts, start=1):
+        row.append(KeyboardButton(text=text))
         if i % 3 == 0:
             rows.append(row)
             row = []
+
     if row:
         rows.append(row)
 
@@ -24,25 +30,32 @@ def make_class_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def make_parallel_keyboard(class_number: str) -> ReplyKeyboardMarkup:
-    variants = CLASS_VARIANTS_BY_PARALLEL.get(class_number, [])
-    rows: List[List[KeyboardButton]] = []
-    row: List[KeyboardButton] = []
+def _ensure_class_keyboards() -> None:
+    # Каталог сменился после обновления таблицы — пересобираем клавиатуры.
+    global _keyboards_catalog, _class_keyboard
 
-    for i, v in enumerate(variants, start=1):
-        row.append(KeyboardButton(text=v))
-        if i % 3 == 0:
-            rows.append(row)
-            row = []
+    catalog = get_catalog()
+    if catalog is _keyboards_catalog:
+        return
 
-    if row:
-        rows.append(row)
+    _class_keyboard = _make_grid_keyboard(catalog.parallels)
+    _parallel_keyboards.clear()
+    for parallel, variants in catalog.variants_by_parallel.items():
+        _parallel_keyboards[parallel] = _make_grid_keyboard(variants)
+    _keyboards_catalog = catalog
 
-    return ReplyKeyboardMarkup(
-        keyboard=rows,
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+
+def make_class_keyboard() -> ReplyKeyboardMarkup:
+    _ensure_class_keyboards()
+    return _class_keyboard
+
+
+def make_parallel_keyboard(class_number: str) -> ReplyKeyboardMarkup:
+    _ensure_class_keyboards()
+    keyboard = _parallel_keyboards.get(class_number)
+    if keyboard is None:
+        keyboard = _make_grid_keyboard([])
+    return keyboard
 
 
 def make_main_menu(has_other: bool = False) -> ReplyKeyboardMarkup:
@@ -51,7 +64,10 @@ def make_main_menu(has_other: bool = False) -> ReplyKeyboardMarkup:
             KeyboardButton(text="📅 На сегодня"),
             KeyboardButton(text="📅 На завтра"),
         ],
-        [KeyboardButton(text="📅 На неделю")],
+        [
+            KeyboardButton(text="📅 На неделю"),
+            KeyboardButton(text="⏰ Сейчас"),
+        ],
     ]
 
     if has_other:
@@ -2,9 +2,9 @@ import logging
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import TOKEN_BOT
+from config import FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL_MS, FSM_STATE_TTL, TOKEN_BOT
+from fsm_storage import SqliteFsmStorage
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,4 +16,9 @@ bot = Bot(
     TOKEN_BOT,
     default=DefaultBotProperties(parse_mode="HTML"),
 )
-dp = Dispatcher(storage=MemoryStorage())
+fsm_storage = SqliteFsmStorage(
+    cache_size=FSM_CACHE_SIZE,
+    ttl=FSM_STATE_TTL,
+    flush_interval=FSM_FLUSH_INTERVAL_MS / 1000,
+)
+dp = Dispatcher(storage=fsm_storage)
@@ -1,12 +1,25 @@
 import asyncio
 
-from loader import bot, dp, logger
+from loader import bot, dp, fsm_storage, logger
 import handlers  # noqa: F401 # зарегистрировать хендлеры
-from middlewares import AntiFloodMiddleware
+import inline_mode  # noqa: F401 # inline-запросы @bot 5 эконом 2 завтра
+import notifications  # noqa: F401 # подписка на изменения расписания
+from broadcast import resume_broadcast, stop_broadcast
+from middlewares import AntiFloodMiddleware, UserLoadMiddleware
+from shedule import (
+    close_http_session,
+    load_snapshot,
+    open_http_session,
+    shutdown_parse_executor,
+    start_schedule_refresher,
+    stop_schedule_refresher,
+)
+from state import close_state, open_state, start_class_index_build, start_user_flusher
 
 async def main() -> None:
     logger.info("Бот запускается...")
 
+    dp.update.outer_middleware(UserLoadMiddleware())
     dp.message.outer_middleware(
         AntiFloodMiddleware(
             interval=1.0,
@@ -15,7 +28,26 @@ async def main() -> None:
         )
     )
 
-    await dp.start_polling(bot)
+    open_state()
+    start_class_index_build()
+    load_snapshot()
+    await open_http_session()
+    start_schedule_refresher()
+    start_user_flusher()
+    fsm_storage.start()
+    resume_broadcast()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # fsm_storage закрывает сам Dispatcher при выходе из start_polling.
+        # Пользователи сбрасываются на диск, даже если упал один из шагов выше.
+        try:
+            await stop_broadcast()
+            await stop_schedule_refresher()
+            await close_http_session()
+            shutdown_parse_executor()
+        finally:
+            await close_state()
 
 
 if __name__ == "__main__":
@@ -1,19 +1,58 @@
 import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from typing import Any, Awaitable, Callable, Dict
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message
 
+from state import load_user
 from utils import is_admin
 
 
+@dataclass
+class FloodStats:
+    tracked_users: int = 0
+    blocked_messages: int = 0
+    blocks: int = 0
+    evicted: int = 0
+
+
+flood_stats = FloodStats()
+
+
+class _FloodRecord:
+    __slots__ = ("last_time", "count", "blocked_until", "notified")
+
+    def __init__(self, now: float):
+        self.last_time = now
+        self.count = 0
+        self.blocked_until = 0.0
+        self.notified = False
+
+
 class AntiFloodMiddleware(BaseMiddleware):
+    # Записи упорядочены по last_time: каждое пропущенное сообщение переносит
+    # запись в конец, поэтому молчащие дольше окна блокировки всегда в начале
+    # и удаляются за O(1) на сообщение. В памяти только недавно писавшие.
 
     def __init__(self, interval: float = 1.0, max_messages: int = 5, block_time: float = 10.0):
         self.interval = interval
         self.max_messages = max_messages
         self.block_time = block_time
-        self.users: Dict[int, Dict[str, Any]] = {}
+        # После такого простоя запись ничего не помнит: счётчик сброшен, блок истёк.
+        self.idle_ttl = max(interval, block_time)
+        self.users: "OrderedDict[int, _FloodRecord]" = OrderedDict()
+
+    def _evict_idle(self, now: float) -> None:
+        users = self.users
+        deadline = now - self.idle_ttl
+        while users:
+            user_id = next(iter(users))
+            if users[user_id].last_time >= deadline:
+                break
+            del users[user_id]
+            flood_stats.evicted += 1
 
     async def __call__(
         self,
@@ -34,39 +73,57 @@ class AntiFloodMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         now = time.monotonic()
+        self._evict_idle(now)
+
         info = self.users.get(user_id)
         if info is None:
-            info = {
-                "last_time": now,
-                "count": 0,
-                "blocked_until": 0.0,
-                "notified": False,
-            }
-            self.users[user_id] = info
-
-        blocked_until = float(info.get("blocked_until", 0.0))
-        if now < blocked_until:
-            return
+            info = self.users[user_id] = _FloodRecord(now)
+        flood_stats.tracked_users = len(self.users)
 
-        last_time = float(info.get("last_time", 0.0))
-        count = int(info.get("count", 0))
+        if now < info.blocked_until:
+            flood_stats.blocked_messages += 1
+            return
 
-        if now - last_time > self.interval:
-            count = 0
-            info["notified"] = False
+        if now - info.last_time > self.interval:
+            info.count = 0
+            info.notified = False
 
-        count += 1
-        info["last_time"] = now
-        info["count"] = count
+        info.count += 1
+        info.last_time = now
+        self.users.move_to_end(user_id)
 
-        if count > self.max_messages:
-            info["blocked_until"] = now + self.block_time
-            if not info.get("notified", False):
+        if info.count > self.max_messages:
+            info.blocked_until = now + self.block_time
+            flood_stats.blocks += 1
+            flood_stats.blocked_messages += 1
+            if not info.notified:
                 try:
                     await event.answer("Слишком много сообщений. Подожди немного и попробуй снова.")
                 except Exception:
                     pass
-                info["notified"] = True
+                info.notified = True
             return  # дальше хендлеры не вызываем
 
         return await handler(event, data)
+
+
+class UserLoadMiddleware(BaseMiddleware):
+    # Пользователь события читается из хранилища до хендлера (state.load_user),
+    # поэтому users.get/ensure в хендлерах берут запись из памяти и не ходят
+    # в базу из event loop. Пока хендлер работает, запись держится ссылкой
+    # и не пропадёт из реестра.
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        chat_ids = {item.id for item in (chat, user) if item is not None}
+        records = [await load_user(chat_id) for chat_id in chat_ids]
+        try:
+            return await handler(event, data)
+        finally:
+            del records
@@ -0,0 +1,68 @@
+import logging
+from typing import List
+
+from broadcast import PRUNED, SENT, deliver, prune_chat
+from shedule import (
+    ScheduleChanges,
+    ScheduleIndex,
+    add_schedule_change_listener,
+    render_day_schedule,
+)
+from state import class_records
+from utils import split_long_text
+
+logger = logging.getLogger(__name__)
+
+
+async def _subscribers(parallel: str, variant: str) -> List[int]:
+    # Пользователи этого класса (по индексу), которые не отключили уведомления.
+    # Чаты, где бот заблокирован (known снят при отправке), пропускаем.
+    return [
+        chat_id
+        for chat_id, record in await class_records(parallel, variant)
+        if record.known and record.get("notify_changes", True)
+    ]
+
+
+async def notify_schedule_changes(index: ScheduleIndex, changes: ScheduleChanges) -> None:
+    # Текст собираем один раз на класс и отправляем всем его подписчикам.
+    for (parallel, variant), days in changes.items():
+        subscribers = await _subscribers(parallel, variant)
+        if not subscribers:
+            continue
+
+        schedule = index.get(parallel, variant)
+        if schedule is None:
+            continue
+
+        parts = [
+            f"⚠️ <b>Изменилось расписание класса {schedule.label}</b> "
+            f"({', '.join(day.lower() for day in days)})."
+        ]
+        parts.extend(render_day_schedule(schedule, day) for day in days)
+        parts.append("Отключить уведомления: /notify")
+        text = "\n\n".join(parts)
+
+        chunks = split_long_text(text)
+
+        sent = pruned = 0
+        for chat_id in subscribers:
+            for chunk in chunks:
+                outcome = await deliver(chat_id, chunk)
+                if outcome != SENT:
+                    break
+            if outcome == SENT:
+                sent += 1
+            elif outcome == PRUNED:
+                await prune_chat(chat_id)
+                pruned += 1
+
+        logger.info(
+            "Изменения класса %s отправлены %d пользователям, недоступных чатов: %d.",
+            schedule.label,
+            sent,
+            pruned,
+        )
+
+
+add_schedule_change_listener(notify_schedule_changes)
@@ -1,109 +1,539 @@
+import asyncio
+import bisect
 import csv
+import functools
+import hashlib
 import io
 import logging
-from dataclasses import dataclass
+import re
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 import aiohttp
 
-from config import DAY_NAMES, SHEET_CSV_URL, SCHEDULE_CACHE_TTL
+from catalog import update_catalog
+from config import (
+    DAY_NAMES,
+    SCHEDULE_CACHE_TTL,
+    SCHEDULE_HTTP_CONNECT_TIMEOUT,
+    SCHEDULE_HTTP_DNS_CACHE_TTL,
+    SCHEDULE_HTTP_POOL_SIZE,
+    SCHEDULE_HTTP_READ_TIMEOUT,
+    SCHEDULE_HTTP_TOTAL_TIMEOUT,
+    SCHEDULE_PARSE_USE_PROCESSES,
+    SCHEDULE_PARSE_WORKERS,
+    SCHEDULE_REFRESH_INTERVAL,
+    SCHEDULE_STALE_MAX_AGE,
+    SHEET_CSV_URLS_BY_PARALLEL,
+)
+from storage import load_schedule_snapshot, save_schedule_snapshot
 from utils import normalize_spaces, get_free_time_text
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(slots=True)
+class Lesson:
+    # Один урок. start/end — минуты от полуночи, если время удалось разобрать.
+    number: Optional[int]
+    subject: str
+    time: str = ""
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+@dataclass
+class DayTimeline:
+    # Уроки дня с известным временем, отсортированные по началу, для bisect.
+    starts: Tuple[int, ...]
+    ends: Tuple[int, ...]
+    lessons: Tuple[Lesson, ...]
+
+
 @dataclass
 class ClassSchedule:
     label: str
     block_title: str
-    days: Dict[str, List[str]]
+    # Уроки дня отсортированы по номеру.
+    days: Dict[str, Tuple[Lesson, ...]]
+    # Версия расписания (хэш CSV), ключ для кэша готовых текстов.
+    version: str = ""
+    timelines: Dict[str, DayTimeline] = field(default_factory=dict)
+
+
+# Вхождение в поисковом индексе: (класс, день, номер урока в ClassSchedule.days[день]).
+# Кортеж, а не объект: их десятки тысяч, и все создаются при разборе таблицы.
+Posting = Tuple[Tuple[str, str], str, int]
+
+
+@dataclass(slots=True)
+class SearchHit:
+    # Найденный урок: какой класс, день и урок.
+    class_key: Tuple[str, str]
+    day: str
+    lesson: Lesson
+
+
+@dataclass
+class ScheduleIndex:
+    # Все классы таблицы, разобранные за один проход: (параллель, вариант) -> расписание.
+    classes: Dict[Tuple[str, str], ClassSchedule]
+    # Хэш CSV, у объединённого индекса — хэш версий всех таблиц.
+    version: str = ""
+    # Поиск: токен (предмет, учитель, кабинет) -> уроки; tokens отсортированы для префиксов.
+    postings: Dict[str, List[Posting]] = field(default_factory=dict)
+    tokens: Tuple[str, ...] = ()
+
+    def get(self, parallel: str, variant: str) -> Optional[ClassSchedule]:
+        return self.classes.get((parallel, normalize_spaces(variant)))
+
+
+# (параллель, вариант) -> дни, в которых расписание изменилось.
+ScheduleChanges = Dict[Tuple[str, str], List[str]]
+ScheduleChangeListener = Callable[[ScheduleIndex, ScheduleChanges], Awaitable[None]]
+
+_BLOCK_TITLE_RE = re.compile(r"^Расписание (\d+) (.+?) класса")
+_TOKEN_RE = re.compile(r"\w+")
+_LESSON_WORDS = frozenset({"урок", "урока", "уроке"})
+_SEARCH_STOP_WORDS = _LESSON_WORDS | {"где", "во", "на", "по", "какие", "классы"}
+# Сокращения и падежные формы дней: "чт", "четверг", "в среду", "по пятницам".
+_DAY_FORMS = {
+    **{"пн": 0, "вт": 1, "ср": 2, "чт": 3, "пт": 4},
+    **{f"понедельник{end}": 0 for end in ("", "а", "у", "ом", "е", "и", "ам")},
+    **{f"вторник{end}": 1 for end in ("", "а", "у", "ом", "е", "и", "ам")},
+    **{f"сред{end}": 2 for end in ("а", "у", "ы", "е", "ой", "ам")},
+    **{f"четверг{end}": 3 for end in ("", "а", "у", "ом", "е", "и", "ам")},
+    **{f"пятниц{end}": 4 for end in ("а", "у", "ы", "е", "ей", "ам")},
+}
+_TIME_RANGE_RE = re.compile(r"(\d{1,2})[:.](\d{2})\s*[-–—]\s*(\d{1,2})[:.](\d{2})")
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_parse_executor: Optional[Executor] = None
+
+
+@dataclass
+class SheetCache:
+    # Кэш одной таблицы: свой текст, время скачивания, валидаторы и single-flight.
+    url: str
+    csv_text: Optional[str] = None
+    cached_at: Optional[datetime] = None
+    # Валидаторы для условного запроса и хэш тела последнего принятого CSV.
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    csv_hash: Optional[str] = None
+    index: Optional[ScheduleIndex] = None
+    # Single-flight: одновременно идёт не больше одного обновления таблицы.
+    refresh_task: Optional["asyncio.Task[Optional[str]]"] = None
+    # Идущее обновление скачивает таблицу заново, без валидаторов.
+    refresh_forced: bool = False
+
+
+def _build_sheets() -> Tuple[Dict[str, SheetCache], Dict[str, SheetCache]]:
+    # Одна таблица может обслуживать несколько параллелей — качаем её один раз.
+    sheets: Dict[str, SheetCache] = {}
+    by_parallel: Dict[str, SheetCache] = {}
+    for parallel, url in SHEET_CSV_URLS_BY_PARALLEL.items():
+        by_parallel[parallel] = sheets.setdefault(url, SheetCache(url=url))
+    return sheets, by_parallel
+
+
+_sheets, _sheet_by_parallel = _build_sheets()
+
+# Сколько запросов дождались чужого обновления вместо своего скачивания.
+coalesced_requests = 0
+
+_refresher_task: Optional["asyncio.Task[None]"] = None
+
+_change_listeners: List[ScheduleChangeListener] = []
+_listener_tasks: Set["asyncio.Task[None]"] = set()
+
+# Объединённый индекс всех таблиц.
+_index: Optional[ScheduleIndex] = None
+
+# Меняется, когда меняется структура ClassSchedule/ScheduleIndex в снимке.
+SNAPSHOT_FORMAT = 8
+_snapshot_lock: Optional[asyncio.Lock] = None
+
+# Готовые тексты: (класс, день или "week", версия) -> HTML.
+_render_cache: Dict[Tuple[str, str, str], str] = {}
+
+
+async def open_http_session() -> aiohttp.ClientSession:
+    # Одна сессия на всё время работы бота: пул keep-alive соединений и кэш DNS.
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=SCHEDULE_HTTP_POOL_SIZE,
+            ttl_dns_cache=SCHEDULE_HTTP_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=SCHEDULE_HTTP_TOTAL_TIMEOUT,
+            connect=SCHEDULE_HTTP_CONNECT_TIMEOUT,
+            sock_read=SCHEDULE_HTTP_READ_TIMEOUT,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _http_session
+
+
+async def close_http_session() -> None:
+    global _http_session
+
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _get_parse_executor() -> Executor:
+    global _parse_executor
+
+    if _parse_executor is None:
+        if SCHEDULE_PARSE_USE_PROCESSES:
+            _parse_executor = ProcessPoolExecutor(max_workers=SCHEDULE_PARSE_WORKERS)
+        else:
+            _parse_executor = ThreadPoolExecutor(
+                max_workers=SCHEDULE_PARSE_WORKERS,
+                thread_name_prefix="schedule-parse",
+            )
+
+    return _parse_executor
+
+
+def shutdown_parse_executor() -> None:
+    global _parse_executor
+
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+    _parse_executor = None
 
 
-_cached_csv_text: Optional[str] = None
-_cached_at: Optional[datetime] = None
+async def _build_index_async(csv_text: str) -> ScheduleIndex:
+    # Разбор в пуле, event loop только подставляет готовый индекс.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_parse_executor(), build_schedule_index, csv_text)
 
 
-async def _download_csv() -> Optional[str]:
-    # Скачивание CSV. Без кэша.
+@dataclass(slots=True)
+class CsvDownload:
+    # Результат скачивания. В SheetCache переносится только вместе с готовым индексом.
+    csv_text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    csv_hash: Optional[str]
+
+
+async def _download_csv(sheet: SheetCache, force: bool = False) -> Optional[CsvDownload]:
+    # Скачивание CSV. Условный запрос: если таблица не менялась (304 или тот же хэш),
+    # возвращаем тот же объект строки из кэша, и индекс не пересобирается.
+    # С force валидаторы и хэш не проверяются. Сам sheet здесь не меняется.
+    headers = {"Accept-Encoding": "gzip"}
+    if sheet.csv_text is not None and not force:
+        if sheet.etag:
+            headers["If-None-Match"] = sheet.etag
+        if sheet.last_modified:
+            headers["If-Modified-Since"] = sheet.last_modified
+
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(SHEET_CSV_URL) as resp:
-                resp.raise_for_status()
-                csv_text = await resp.text()
+        session = await open_http_session()
+        async with session.get(sheet.url, headers=headers) as resp:
+            if resp.status == 304 and sheet.csv_text is not None:
+                logger.debug("CSV не изменился (304): %s", sheet.url)
+                return CsvDownload(sheet.csv_text, sheet.etag, sheet.last_modified, sheet.csv_hash)
+            resp.raise_for_status()
+            body = await resp.read()
+            charset = resp.charset or "utf-8"
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
     except Exception as e:
-        logger.exception("Ошибка запроса CSV: %s", e)
+        logger.exception("Ошибка запроса CSV %s: %s", sheet.url, e)
         return None
 
+    body_hash = hashlib.sha256(body).hexdigest()
+    if body_hash == sheet.csv_hash and sheet.csv_text is not None and not force:
+        logger.debug("CSV не изменился (тот же хэш): %s", sheet.url)
+        return CsvDownload(sheet.csv_text, etag, last_modified, body_hash)
+
+    csv_text = body.decode(charset, errors="replace")
+
     if csv_text.lstrip().startswith("<"):
-        logger.error("Ожидался CSV, но получен HTML. Проверь ссылку/доступ.")
+        logger.error("Ожидался CSV, но получен HTML. Проверь ссылку/доступ: %s", sheet.url)
         return None
 
-    return csv_text
+    return CsvDownload(csv_text, etag, last_modified, body_hash)
+
+
+async def _refresh_sheet(sheet: SheetCache, force: bool = False) -> Optional[str]:
+    download = await _download_csv(sheet, force)
+    if download is None:
+        return None
+
+    is_new = download.csv_text is not sheet.csv_text
+    old_index = sheet.index
+    if is_new:
+        # Сначала индекс: пока он строится, запросы видят прежнюю таблицу
+        # (или ждут это обновление). Если разбор упадёт, кэш останется старым,
+        # и следующее обновление попробует снова.
+        sheet.index = await _build_index_async(download.csv_text)
+
+    sheet.csv_text = download.csv_text
+    sheet.cached_at = datetime.utcnow()
+    sheet.etag = download.etag
+    sheet.last_modified = download.last_modified
+    sheet.csv_hash = download.csv_hash
+
+    if is_new:
+        _rebuild_index()
+        await _save_snapshot()
+        if old_index is not None and _index is not None:
+            changes = diff_schedule_indexes(old_index, sheet.index)
+            if changes:
+                _emit_schedule_changes(_index, changes)
+
+    return download.csv_text
+
+
+def add_schedule_change_listener(listener: ScheduleChangeListener) -> None:
+    # Слушатель вызывается, когда обновление принесло изменения в расписании.
+    _change_listeners.append(listener)
+
+
+def _emit_schedule_changes(index: ScheduleIndex, changes: ScheduleChanges) -> None:
+    # Рассылка идёт в фоне, обновление кэша её не ждёт.
+    logger.info("Расписание изменилось у %d классов.", len(changes))
+    for listener in _change_listeners:
+        task = asyncio.create_task(listener(index, changes))
+        _listener_tasks.add(task)
+        task.add_done_callback(_listener_tasks.discard)
+
+
+def diff_schedule_indexes(old: ScheduleIndex, new: ScheduleIndex) -> ScheduleChanges:
+    # Сравниваем по классам и дням. У нового класса изменены все дни с уроками,
+    # пропавшие классы не интересны — показывать по ним нечего.
+    changes: ScheduleChanges = {}
+
+    for key, new_schedule in new.classes.items():
+        old_schedule = old.classes.get(key)
+        old_days = old_schedule.days if old_schedule is not None else {}
+        changed_days = [
+            day
+            for day in DAY_NAMES
+            if old_days.get(day, ()) != new_schedule.days.get(day, ())
+        ]
+        if changed_days:
+            changes[key] = changed_days
+
+    return changes
+
 
+def _log_refresh_error(sheet: SheetCache, task: "asyncio.Task[Optional[str]]") -> None:
+    # Фоновое обновление (устаревший кэш) никто не ждёт — ошибку пишем сами.
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка обновления таблицы %s: %r", sheet.url, task.exception())
 
-async def get_csv_text_cached() -> Optional[str]:
-    # Получаем CSV с кэшем.
-    global _cached_csv_text, _cached_at
+
+async def _refresh_after(previous: "asyncio.Task[Optional[str]]", sheet: SheetCache) -> Optional[str]:
+    await asyncio.wait([previous])
+    return await _refresh_sheet(sheet, force=True)
+
+
+def _start_refresh(sheet: SheetCache, force: bool = False) -> "asyncio.Task[Optional[str]]":
+    # Запускает обновление таблицы, если оно ещё не идёт, иначе возвращает текущее.
+    # Принудительное не присоединяется к обычному: ждёт его и скачивает заново.
+    if sheet.refresh_task is None or sheet.refresh_task.done():
+        coro = _refresh_sheet(sheet, force)
+    elif force and not sheet.refresh_forced:
+        coro = _refresh_after(sheet.refresh_task, sheet)
+    else:
+        return sheet.refresh_task
+
+    sheet.refresh_task = asyncio.create_task(coro)
+    sheet.refresh_task.add_done_callback(functools.partial(_log_refresh_error, sheet))
+    sheet.refresh_forced = force
+    return sheet.refresh_task
+
+
+async def _get_sheet_text_cached(sheet: SheetCache) -> Optional[str]:
+    # Получаем CSV с кэшем. Устаревший кэш отдаём сразу и обновляем его в фоне,
+    # пока он не старше SCHEDULE_STALE_MAX_AGE.
+    global coalesced_requests
 
     now = datetime.utcnow()
-    if _cached_csv_text is not None and _cached_at is not None:
-        if now - _cached_at < timedelta(seconds=SCHEDULE_CACHE_TTL):
-            return _cached_csv_text
+    if sheet.csv_text is not None and sheet.cached_at is not None:
+        age = now - sheet.cached_at
+        if age < timedelta(seconds=SCHEDULE_CACHE_TTL):
+            return sheet.csv_text
+        if age < timedelta(seconds=SCHEDULE_STALE_MAX_AGE):
+            _start_refresh(sheet)
+            return sheet.csv_text
+
+    if sheet.refresh_task is not None and not sheet.refresh_task.done():
+        coalesced_requests += 1
+
+    # shield: отмена одного хендлера не отменяет обновление для остальных.
+    return await asyncio.shield(_start_refresh(sheet))
+
+
+async def refresh_now(force: bool = False) -> bool:
+    # Внеочередное обновление всех таблиц параллельно. True, если скачались все.
+    # force — скачать и разобрать заново, даже если таблица не менялась.
+    # Ошибки пишет _log_refresh_error.
+    results = await asyncio.gather(
+        *(asyncio.shield(_start_refresh(sheet, force)) for sheet in _sheets.values()),
+        return_exceptions=True,
+    )
+    return all(isinstance(result, str) for result in results)
 
-    csv_text = await _download_csv()
-    if csv_text is not None:
-        _cached_csv_text = csv_text
-        _cached_at = now
 
-    return csv_text
+async def _refresher_loop() -> None:
+    while True:
+        try:
+            if not await refresh_now():
+                logger.warning("Фоновое обновление расписания не удалось, используется кэш.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Ошибка фонового обновления расписания: %s", e)
+        await asyncio.sleep(SCHEDULE_REFRESH_INTERVAL)
 
 
-def reset_cache() -> None:
-    # Сброс кэша CSV админ-команда.
-    global _cached_csv_text, _cached_at
-    _cached_csv_text = None
-    _cached_at = None
+def start_schedule_refresher() -> None:
+    global _refresher_task
 
+    if _refresher_task is None or _refresher_task.done():
+        _refresher_task = asyncio.create_task(_refresher_loop())
 
-async def get_class_schedule(parallel: str, variant: str) -> Tuple[Optional[ClassSchedule], Optional[str]]:
-    # Возвращает расписание
-    class_label = f"{parallel} {variant}"
-    block_title = f"Расписание {parallel} {variant} класса"
-    block_title_norm = normalize_spaces(block_title)
 
-    csv_text = await get_csv_text_cached()
-    if csv_text is None:
-        return None, (
-            "Не получилось получить данные с Google Sheets.\n"
-            "Проверь ссылку, доступ к таблице и формат экспорта (CSV)."
-        )
+async def stop_schedule_refresher() -> None:
+    global _refresher_task
+
+    if _refresher_task is None:
+        return
+    _refresher_task.cancel()
+    try:
+        await _refresher_task
+    except asyncio.CancelledError:
+        pass
+    _refresher_task = None
+
+
+def get_cache_stats() -> Dict[str, int]:
+    now = datetime.utcnow()
+    ages = [
+        int((now - sheet.cached_at).total_seconds())
+        for sheet in _sheets.values()
+        if sheet.cached_at is not None
+    ]
+    return {
+        "sheets": len(_sheets),
+        "sheets_cached": len(ages),
+        "max_age_seconds": max(ages, default=0),
+        "coalesced_requests": coalesced_requests,
+    }
+
+
+def _parse_time_range(time: str) -> Tuple[Optional[int], Optional[int]]:
+    # "9:00-9:45" -> (540, 585)
+    match = _TIME_RANGE_RE.search(time)
+    if not match:
+        return None, None
+    h1, m1, h2, m2 = (int(g) for g in match.groups())
+    return h1 * 60 + m1, h2 * 60 + m2
+
+
+def _sort_lessons(lessons: List[Lesson]) -> Tuple[Lesson, ...]:
+    # Уроки с номером по порядку, без номера — в конце в исходном порядке.
+    return tuple(
+        sorted(lessons, key=lambda lesson: (lesson.number is None, lesson.number or 0))
+    )
+
+
+def _tokenize(text: str) -> List[str]:
+    # "Иванова И.И." -> ["иванова"]
+    words = _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+    return [w for w in words if len(w) > 1]
+
+
+def _tokenize_subject(subject: str, line_tokens: Dict[str, List[str]]) -> Set[str]:
+    # "Алгебра\nИванова И.И.\nкаб. 201" -> {"алгебра", "иванова", "каб", "201"}
+    # Предметы, учителя и кабинеты повторяются по строкам, поэтому кэшируем строку.
+    tokens: Set[str] = set()
+    for line in subject.split("\n"):
+        words = line_tokens.get(line)
+        if words is None:
+            words = line_tokens[line] = _tokenize(line)
+        tokens.update(words)
+    return tokens
+
 
+def _build_timeline(lessons: Tuple[Lesson, ...]) -> DayTimeline:
+    timed = sorted(
+        (lesson for lesson in lessons if lesson.start is not None and lesson.end is not None),
+        key=lambda lesson: lesson.start,
+    )
+    return DayTimeline(
+        starts=tuple(lesson.start for lesson in timed),
+        ends=tuple(lesson.end for lesson in timed),
+        lessons=tuple(timed),
+    )
+
+
+def build_schedule_index(csv_text: str) -> ScheduleIndex:
+    # Один проход по CSV: собираем все блоки «Расписание N X класса».
     reader = csv.reader(io.StringIO(csv_text))
+    version = hashlib.sha256(csv_text.encode("utf-8")).hexdigest()[:16]
+
+    classes: Dict[Tuple[str, str], ClassSchedule] = {}
+    postings: Dict[str, List[Posting]] = {}
+    subject_tokens: Dict[str, Set[str]] = {}
+    line_tokens: Dict[str, List[str]] = {}
 
-    in_block = False
+    current_key: Optional[Tuple[str, str]] = None
     header_processed = False
     day_indices: Dict[str, int] = {}
-    day_to_lessons: Dict[str, List[str]] = {}
+    day_to_lessons: Dict[str, List[Lesson]] = {}
+
+    def finish_block() -> None:
+        if current_key is None or not day_to_lessons or current_key in classes:
+            return
+        parallel, variant = current_key
+        days = {day: _sort_lessons(lessons) for day, lessons in day_to_lessons.items()}
+        classes[current_key] = ClassSchedule(
+            label=f"{parallel} {variant}",
+            block_title=f"Расписание {parallel} {variant} класса",
+            days=days,
+            version=version,
+            timelines={day: _build_timeline(lessons) for day, lessons in days.items()},
+        )
+
+        for day, lessons in days.items():
+            for i, lesson in enumerate(lessons):
+                tokens = subject_tokens.get(lesson.subject)
+                if tokens is None:
+                    tokens = subject_tokens[lesson.subject] = _tokenize_subject(lesson.subject, line_tokens)
+                posting = (current_key, day, i)
+                for token in tokens:
+                    postings.setdefault(token, []).append(posting)
 
     for row in reader:
         nonempty_cells = [cell.strip() for cell in row if cell.strip()]
         joined = " ".join(nonempty_cells)
         joined_norm = normalize_spaces(joined) if joined else ""
 
-        if not in_block:
-            if joined_norm and joined_norm.startswith(block_title_norm):
-                in_block = True
-                header_processed = False
-                day_indices.clear()
+        if joined_norm.startswith("Расписание ") and "класса" in joined_norm:
+            finish_block()
+            match = _BLOCK_TITLE_RE.match(joined_norm)
+            current_key = (match.group(1), match.group(2)) if match else None
+            header_processed = False
+            day_indices = {}
+            day_to_lessons = {}
             continue
 
-        if (
-            joined_norm.startswith("Расписание ")
-            and "класса" in joined_norm
-            and not joined_norm.startswith(block_title_norm)
-        ):
-            break
+        if current_key is None:
+            continue
 
         if not header_processed and any("№ урока" in cell for cell in row):
             for idx, cell in enumerate(row):
@@ -122,7 +552,9 @@ async def get_class_schedule(parallel: str, variant: str) -> Tuple[Optional[Clas
         lesson_cell = row[0].strip()
         parts = lesson_cell.splitlines()
         lesson_num = parts[0].strip()
-        time = parts[1].strip() if len(parts) > 1 else ""
+        time = sys.intern(parts[1].strip()) if len(parts) > 1 else ""
+        number = int(lesson_num) if lesson_num.isdigit() else None
+        start, end = _parse_time_range(time)
 
         for day, idx in day_indices.items():
             if idx >= len(row):
@@ -131,61 +563,226 @@ async def get_class_schedule(parallel: str, variant: str) -> Tuple[Optional[Clas
             if not subject:
                 continue
 
-            line = f"{lesson_num}. {subject}"
-            if time:
-                line += f" ({time})"
+            lesson = Lesson(
+                number=number,
+                subject=sys.intern(subject),
+                time=time,
+                start=start,
+                end=end,
+            )
+            day_to_lessons.setdefault(day, []).append(lesson)
+
+    finish_block()
+
+    return ScheduleIndex(
+        classes=classes,
+        version=version,
+        postings=postings,
+        tokens=tuple(sorted(postings)),
+    )
+
+
+async def get_schedule_index(parallel: Optional[str] = None) -> Optional[ScheduleIndex]:
+    # Индекс по всем таблицам. С parallel освежаем только её таблицу, остальные не ждём.
+    if parallel is not None and parallel in _sheet_by_parallel:
+        sheets = [_sheet_by_parallel[parallel]]
+    else:
+        sheets = list(_sheets.values())
+
+    results = await asyncio.gather(
+        *(_get_sheet_text_cached(sheet) for sheet in sheets),
+        return_exceptions=True,
+    )
+    if not any(isinstance(result, str) for result in results):
+        return None
+
+    return _index
+
+
+def _rebuild_index() -> None:
+    # Склеиваем индексы таблиц. Класс берём из таблицы его параллели, если она задана.
+    global _index
+
+    classes: Dict[Tuple[str, str], ClassSchedule] = {}
+    versions: List[str] = []
+    indexes = [sheet.index for sheet in _sheets.values() if sheet.index is not None]
+
+    for sheet in _sheets.values():
+        if sheet.index is None:
+            continue
+        versions.append(sheet.index.version)
+        for key, schedule in sheet.index.classes.items():
+            if _sheet_by_parallel.get(key[0]) is sheet:
+                classes[key] = schedule
+            else:
+                classes.setdefault(key, schedule)
+
+    if not versions:
+        _index = None
+        return
+
+    if len(indexes) == 1:
+        postings = indexes[0].postings
+        tokens = indexes[0].tokens
+    else:
+        # Берём только вхождения классов, попавших в объединённый индекс.
+        postings = {}
+        for sheet_index in indexes:
+            for token, entries in sheet_index.postings.items():
+                for posting in entries:
+                    if classes.get(posting[0]) is sheet_index.classes.get(posting[0]):
+                        postings.setdefault(token, []).append(posting)
+        tokens = tuple(sorted(postings))
+
+    version = hashlib.sha256("|".join(versions).encode("utf-8")).hexdigest()[:16]
+    _index = ScheduleIndex(classes=classes, version=version, postings=postings, tokens=tokens)
+    _render_cache.clear()
+
+    catalog = update_catalog(classes.keys())
+    if catalog is not None:
+        logger.info(
+            "Каталог классов обновлён: %d параллелей, %d классов.",
+            len(catalog.parallels),
+            len(catalog.class_set),
+        )
+
+
+async def _save_snapshot() -> None:
+    # Таблицы обновляются параллельно, а файл снимка один: сохраняем по очереди,
+    # и каждый следующий снимок собирается уже под блокировкой — на диске
+    # остаётся самый свежий.
+    global _snapshot_lock
+
+    if _snapshot_lock is None:
+        _snapshot_lock = asyncio.Lock()
+
+    async with _snapshot_lock:
+        await _write_snapshot()
+
+
+async def _write_snapshot() -> None:
+    data = {
+        "format": SNAPSHOT_FORMAT,
+        "sheets": {
+            sheet.url: {
+                "saved_at": sheet.cached_at,
+                "csv_text": sheet.csv_text,
+                "csv_hash": sheet.csv_hash,
+                "etag": sheet.etag,
+                "last_modified": sheet.last_modified,
+                "index": sheet.index,
+            }
+            for sheet in _sheets.values()
+            if sheet.csv_text is not None
+        },
+    }
+    try:
+        await asyncio.to_thread(save_schedule_snapshot, data)
+    except Exception as e:
+        logger.exception("Не удалось сохранить снимок расписания: %s", e)
+
+
+def load_snapshot() -> bool:
+    # Тёплый старт: поднимаем последние удачные CSV с диска до начала polling.
+    data = load_schedule_snapshot()
+    if data is None:
+        return False
+
+    raw_sheets = data.get("sheets")
+    if not isinstance(raw_sheets, dict):
+        return False
+
+    same_format = data.get("format") == SNAPSHOT_FORMAT
+    loaded = 0
+
+    for url, raw in raw_sheets.items():
+        sheet = _sheets.get(url)
+        if sheet is None or not isinstance(raw, dict):
+            continue
+
+        csv_text = raw.get("csv_text")
+        saved_at = raw.get("saved_at")
+        if not isinstance(csv_text, str) or not isinstance(saved_at, datetime):
+            continue
+
+        sheet.csv_text = csv_text
+        sheet.cached_at = saved_at
+        sheet.etag = raw.get("etag")
+        sheet.last_modified = raw.get("last_modified")
+        sheet.csv_hash = raw.get("csv_hash")
+
+        index = raw.get("index")
+        if same_format and isinstance(index, ScheduleIndex):
+            sheet.index = index
+        else:
+            sheet.index = build_schedule_index(csv_text)
+
+        loaded += 1
+        logger.info("Загружен снимок таблицы от %s: %s", saved_at, url)
+
+    if not loaded:
+        return False
 
-            day_to_lessons.setdefault(day, []).append(line)
+    _rebuild_index()
+    return True
 
-    if not day_to_lessons:
+
+async def get_class_schedule(parallel: str, variant: str) -> Tuple[Optional[ClassSchedule], Optional[str]]:
+    # Возвращает расписание
+    class_label = f"{parallel} {variant}"
+    block_title = f"Расписание {parallel} {variant} класса"
+
+    index = await get_schedule_index(parallel)
+    if index is None:
+        return None, (
+            "Не получилось получить данные с Google Sheets.\n"
+            "Проверь ссылку, доступ к таблице и формат экспорта (CSV)."
+        )
+
+    schedule = index.get(parallel, variant)
+    if schedule is None:
         return None, (
             f"Не удалось найти расписание для класса {class_label}.\n"
             f"Убедись, что в таблице есть строка с заголовком «{block_title}»."
         )
 
-    schedule = ClassSchedule(
-        label=class_label,
-        block_title=block_title,
-        days=day_to_lessons,
-    )
     return schedule, None
 
 
-def _fill_missing_lessons_with_free_time(lessons: List[str]) -> List[str]:
-    # Добавляем смайлики
-    if not lessons:
-        return lessons
-
-    num_to_line: Dict[int, str] = {}
-    extra_lines: List[str] = []
-
-    for line in lessons:
-        stripped = line.lstrip()
-        parts = stripped.split(".", 1)
-        first = parts[0].strip() if parts else ""
-        if first.isdigit():
-            num = int(first)
-            num_to_line[num] = line
-        else:
-            extra_lines.append(line)
+def _format_lesson(lesson: Lesson) -> str:
+    line = f"{lesson.number}. {lesson.subject}" if lesson.number is not None else lesson.subject
+    if lesson.time:
+        line += f" ({lesson.time})"
+    return line
 
-    if not num_to_line:
-        return lessons
 
-    max_num = max(num_to_line.keys())
+def _fill_missing_lessons_with_free_time(lessons: Tuple[Lesson, ...], seed: str = "") -> List[str]:
+    # Добавляем смайлики в пропущенные номера уроков.
+    result: List[str] = []
+    expected = 1
 
-    for n in range(1, max_num + 1):
-        if n not in num_to_line:
-            phrase = get_free_time_text()
-            num_to_line[n] = f"{n}. {phrase}"
+    for lesson in lessons:
+        if lesson.number is not None:
+            for n in range(expected, lesson.number):
+                result.append(f"{n}. {get_free_time_text(f'{seed}:{n}')}")
+            expected = max(expected, lesson.number + 1)
+        result.append(_format_lesson(lesson))
 
-    result: List[str] = [num_to_line[n] for n in sorted(num_to_line.keys())]
-    result.extend(extra_lines)
     return result
 
 
+def _get_cached_render(schedule: ClassSchedule, key: str) -> Tuple[Tuple[str, str, str], Optional[str]]:
+    # Кэш очищается в _rebuild_index, когда приходит новая версия таблицы.
+    cache_key = (schedule.label, key, schedule.version)
+    return cache_key, _render_cache.get(cache_key)
+
+
 def render_full_schedule(schedule: ClassSchedule) -> str:
     # Текст
+    cache_key, cached = _get_cached_render(schedule, "week")
+    if cached is not None:
+        return cached
+
     lines: List[str] = [
         f"<b>Расписание для класса {schedule.label}</b>",
         f"({schedule.block_title})",
@@ -197,24 +794,35 @@ def render_full_schedule(schedule: ClassSchedule) -> str:
         if not lessons:
             continue
 
-        lessons = _fill_missing_lessons_with_free_time(lessons)
+        seed = f"{schedule.label}|{day}|{schedule.version}"
+        lessons = _fill_missing_lessons_with_free_time(lessons, seed)
 
         lines.append(f"<b>{day}:</b>")
         for lesson_line in lessons:
             lines.append(f"• {lesson_line}")
         lines.append("")
 
-    return "\n".join(lines).rstrip()
+    text = "\n".join(lines).rstrip()
+    _render_cache[cache_key] = text
+    return text
 
 
 def render_day_schedule(schedule: ClassSchedule, day_name: str) -> str:
     # Расписание на один день
+    cache_key, cached = _get_cached_render(schedule, day_name)
+    if cached is not None:
+        return cached
+
+    seed = f"{schedule.label}|{day_name}|{schedule.version}"
+
     lessons = schedule.days.get(day_name)
     if not lessons:
-        phrase = get_free_time_text()
-        return f"<b>{day_name}</b>: уроков нет. {phrase}"
+        phrase = get_free_time_text(seed)
+        text = f"<b>{day_name}</b>: уроков нет. {phrase}"
+        _render_cache[cache_key] = text
+        return text
 
-    lessons = _fill_missing_lessons_with_free_time(lessons)
+    lessons = _fill_missing_lessons_with_free_time(lessons, seed)
 
     lines: List[str] = [
         f"<b>Расписание для класса {schedule.label} на {day_name.lower()}:</b>",
@@ -223,7 +831,159 @@ def render_day_schedule(schedule: ClassSchedule, day_name: str) -> str:
     for lesson_line in lessons:
         lines.append(f"• {lesson_line}")
 
-    return "\n".join(lines).rstrip()
+    text = "\n".join(lines).rstrip()
+    _render_cache[cache_key] = text
+    return text
+
+
+def find_current_lesson(
+    schedule: ClassSchedule, day_name: str, minute: int
+) -> Tuple[Optional[Lesson], Optional[Lesson]]:
+    # (текущий урок, следующий урок) на минуту дня. bisect по началам уроков.
+    timeline = schedule.timelines.get(day_name)
+    if timeline is None or not timeline.starts:
+        return None, None
+
+    i = bisect.bisect_right(timeline.starts, minute)
+    current = timeline.lessons[i - 1] if i > 0 and minute < timeline.ends[i - 1] else None
+    upcoming = timeline.lessons[i] if i < len(timeline.lessons) else None
+    return current, upcoming
+
+
+def _format_minute(minute: int) -> str:
+    return f"{minute // 60}:{minute % 60:02d}"
+
+
+def render_now(schedule: ClassSchedule, day_name: str, minute: int) -> str:
+    # Что идёт сейчас и что будет дальше.
+    title = f"<b>{schedule.label}, {day_name.lower()}, {_format_minute(minute)}</b>"
+
+    timeline = schedule.timelines.get(day_name)
+    if timeline is None or not timeline.starts:
+        if schedule.days.get(day_name):
+            return f"{title}\nВ таблице не указано время уроков на этот день."
+        phrase = get_free_time_text(f"{schedule.label}|{day_name}|{schedule.version}")
+        return f"{title}\nСегодня уроков нет. {phrase}"
+
+    current, upcoming = find_current_lesson(schedule, day_name, minute)
+    lines = [title]
+
+    if current is not None:
+        left = current.end - minute
+        lines.append(
+            f"Сейчас: {_format_lesson(current)}\n"
+            f"До конца урока {left} мин."
+        )
+    elif upcoming is not None and minute >= timeline.starts[0]:
+        lines.append("Сейчас перемена.")
+
+    if upcoming is not None:
+        wait = upcoming.start - minute
+        lines.append(
+            f"Следующий: {_format_lesson(upcoming)}\n"
+            f"Начало в {_format_minute(upcoming.start)}, через {wait} мин."
+        )
+    elif current is None:
+        phrase = get_free_time_text(f"{schedule.label}|{day_name}|{schedule.version}")
+        lines.append(f"Уроки на сегодня закончились. {phrase}")
+
+    return "\n\n".join(lines)
+
+
+def match_day_name(token: str) -> Optional[str]:
+    # "чт", "четверг", "четвергам", "среду" -> название дня.
+    # Только целые формы: "второй", "средний" — обычные слова запроса.
+    idx = _DAY_FORMS.get(token.lower())
+    return DAY_NAMES[idx] if idx is not None else None
+
+
+def _iter_prefix_tokens(index: ScheduleIndex, prefix: str):
+    # Токены индекса, начинающиеся с prefix: bisect по отсортированному списку.
+    i = bisect.bisect_left(index.tokens, prefix)
+    while i < len(index.tokens) and index.tokens[i].startswith(prefix):
+        yield index.tokens[i]
+        i += 1
+
+
+def _marked_lesson_numbers(tokens: List[str]) -> Set[int]:
+    # Позиции чисел с пометкой "урок": "урок 3", "3 урок". "каб 15 урок 6" — только 6.
+    marked: Set[int] = set()
+    used: Set[int] = set()
+    for i, token in enumerate(tokens[:-1]):
+        if token in _LESSON_WORDS and tokens[i + 1].isdigit():
+            marked.add(i + 1)
+            used.add(i)
+    for i, token in enumerate(tokens):
+        if i > 0 and i not in used and token in _LESSON_WORDS and tokens[i - 1].isdigit():
+            marked.add(i - 1)
+    return marked
+
+
+def search_lessons(index: ScheduleIndex, query: str) -> List[SearchHit]:
+    # Слова запроса — префиксы (все должны совпасть). День недели в запросе — фильтр.
+    # Одна-две цифры — номер урока, если рядом "урок" или такого токена нет в индексе
+    # ("3 урок", "алгебра 3"); иначе это обычное слово ("каб 15").
+    day_filter: Optional[str] = None
+    number_filter: Optional[int] = None
+    words: List[str] = []
+
+    tokens = _TOKEN_RE.findall(query.lower().replace("ё", "е"))
+    marked = _marked_lesson_numbers(tokens)
+    for i, token in enumerate(tokens):
+        day = match_day_name(token)
+        if day is not None:
+            day_filter = day
+        elif token.isdigit() and len(token) <= 2 and (i in marked or token not in index.postings):
+            number_filter = int(token)
+        elif len(token) > 1 and token not in _SEARCH_STOP_WORDS:
+            words.append(token)
+
+    if not words:
+        return []
+
+    found: Optional[Set[Posting]] = None
+    for word in words:
+        entries = {
+            posting
+            for token in _iter_prefix_tokens(index, word)
+            for posting in index.postings[token]
+        }
+        found = entries if found is None else found & entries
+        if not found:
+            return []
+
+    result = []
+    for class_key, day, i in found:
+        lesson = index.classes[class_key].days[day][i]
+        if (day_filter is None or day == day_filter) and (
+            number_filter is None or lesson.number == number_filter
+        ):
+            result.append(SearchHit(class_key=class_key, day=day, lesson=lesson))
+    result.sort(
+        key=lambda hit: (
+            DAY_NAMES.index(hit.day),
+            hit.lesson.number or 0,
+            int(hit.class_key[0]),
+            hit.class_key[1],
+        )
+    )
+    return result
+
+
+def render_search_results(hits: List[SearchHit], limit: int = 30) -> str:
+    lines = [f"<b>Нашлось уроков: {len(hits)}</b>", ""]
+    for hit in hits[:limit]:
+        parallel, variant = hit.class_key
+        lesson_text = _format_lesson(hit.lesson).replace("\n", ", ")
+        lines.append(f"• {hit.day}, {parallel} {variant}: {lesson_text}")
+    if len(hits) > limit:
+        lines.append(f"… и ещё {len(hits) - limit}. Уточни запрос.")
+    return "\n".join(lines)
+
+
+def get_current_minute() -> int:
+    now = datetime.now()
+    return now.hour * 60 + now.minute
 
 
 def _day_name_for_date(d: date) -> Optional[str]:
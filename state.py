@@ -1,10 +1,20 @@
-from typing import Dict, Set, TypedDict
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Set, Tuple, TypedDict
 
 from aiogram.fsm.state import State, StatesGroup
 
-from storage import load_state, save_state as _save_state
+from config import USER_CACHE_SIZE, USER_FLUSH_INTERVAL_MS, USER_FLUSH_MAX_PENDING
+from user_registry import UserRecord, UserRegistry
+from user_store import UserStore, open_user_store
 
+logger = logging.getLogger(__name__)
 
+
+# Поля профиля; в памяти они лежат в user_registry.UserRecord.
 class UserSettings(TypedDict, total=False):
     # Профиль
     first_name: str
@@ -18,6 +28,9 @@ class UserSettings(TypedDict, total=False):
     other_parallel: str
     other_variant: str
 
+    # Уведомления об изменениях расписания (по умолчанию включены)
+    notify_changes: bool
+
 
 class UserStates(StatesGroup):
     # Регистрация
@@ -36,12 +49,181 @@ class UserStates(StatesGroup):
     idle = State()
 
 
-_loaded_user_settings, _loaded_known_users = load_state()
+# Все пользователи: профиль и признак known в одной записи.
+# Заполняется в open_state() при старте бота, а не при импорте.
+users = UserRegistry(cache_size=USER_CACHE_SIZE)
+store: Optional[UserStore] = None
+_class_index_task: Optional["asyncio.Future[None]"] = None
+
+# Все обращения к хранилищу идут в одном потоке: порядок записей сохраняется,
+# а event loop не ждёт диск.
+_store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
+
+
+def open_state() -> None:
+    global store
+
+    if store is not None:
+        return
+
+    started = time.perf_counter()
+    store = open_user_store()
+    store.load_registry(users)
+    logger.info(
+        "Пользователи загружены за %.1f мс: %d",
+        (time.perf_counter() - started) * 1000,
+        len(users),
+    )
+
+
+async def _in_store_thread(func: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_store_executor, func, *args)
+
+
+async def load_user(chat_id: int) -> Optional[UserRecord]:
+    # Запись пользователя. Если основа реестра — база (SQLite), промах кэша
+    # читается в потоке хранилища, и дальше users.get отдаёт запись из памяти.
+    if store is not None and users.needs_load(chat_id):
+        return users.remember(chat_id, await _in_store_thread(store.get, chat_id))
+    return users.get(chat_id)
+
+
+async def known_ids() -> List[int]:
+    # Все известные чаты (для рассылки и /stats), база читается не в event loop.
+    if store is not None and users.lazy:
+        return users.known_ids(await _in_store_thread(store.known_ids))
+    return users.known_ids()
+
+
+async def class_records(parallel: str, variant: str) -> List[Tuple[int, UserRecord]]:
+    # Пользователи класса с записями, одним запросом к базе по индексу.
+    if store is not None and users.lazy:
+        rows = await _in_store_thread(store.class_rows, parallel, variant)
+        return users.class_records(parallel, variant, rows)
+    return users.class_records(parallel, variant)
+
+
+def start_class_index_build() -> None:
+    # Индекс по классам строится по снимку в фоне, чтобы не задерживать старт.
+    # Если он понадобится раньше, class_members построит его сам.
+    global _class_index_task
+
+    _class_index_task = asyncio.create_task(asyncio.to_thread(users.build_class_index))
+
+
+@dataclass
+class FlushStats:
+    flushes: int = 0
+    users_written: int = 0
+    errors: int = 0
+    last_latency_ms: float = 0.0
+    max_latency_ms: float = 0.0
+
+    @property
+    def pending(self) -> int:
+        # Глубина очереди: сколько чатов ждут записи.
+        return len(_dirty)
+
+
+flush_stats = FlushStats()
+
+# Чаты, изменённые после последней записи. Хендлеры только помечают,
+# пишет фоновая задача пачками.
+_dirty: Set[int] = set()
+_flush_wakeup: Optional[asyncio.Event] = None
+_flush_lock: Optional[asyncio.Lock] = None
+_flusher_task: Optional["asyncio.Task[None]"] = None
+
+
+def mark_dirty(chat_id: int) -> None:
+    users.mark_changed(chat_id)
+    _dirty.add(chat_id)
+    if len(_dirty) >= USER_FLUSH_MAX_PENDING and _flush_wakeup is not None:
+        _flush_wakeup.set()
+
+
+def mark_known(chat_id: int) -> None:
+    record = users.ensure(chat_id)
+    if not record.known:
+        record.known = True
+        mark_dirty(chat_id)
+
+
+async def flush_users() -> None:
+    # Записать все накопленные изменения одной пачкой в потоке хранилища.
+    global _flush_lock
+
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+
+    async with _flush_lock:
+        if not _dirty or store is None:
+            return
+
+        rows = [
+            (chat_id, record.to_dict(), record.known)
+            for chat_id in _dirty
+            if (record := users.get(chat_id)) is not None
+        ]
+        _dirty.clear()
+
+        started = time.perf_counter()
+        try:
+            await _in_store_thread(store.upsert_many, rows)
+        except Exception as e:
+            # Не потеряем изменения: вернём чаты в очередь до следующей попытки.
+            flush_stats.errors += 1
+            _dirty.update(chat_id for chat_id, _, _ in rows)
+            logger.exception("Ошибка записи пользователей в хранилище: %s", e)
+            return
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        flush_stats.flushes += 1
+        flush_stats.users_written += len(rows)
+        flush_stats.last_latency_ms = latency_ms
+        flush_stats.max_latency_ms = max(flush_stats.max_latency_ms, latency_ms)
+
+        # Записанное (и не изменённое снова за время записи) больше не держим в памяти.
+        if store.flushed(users, [chat_id for chat_id, _, _ in rows], _dirty):
+            start_class_index_build()
+
+
+async def _flusher_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=USER_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        await flush_users()
+
+
+def start_user_flusher() -> None:
+    global _flush_wakeup, _flusher_task
+
+    if _flusher_task is None or _flusher_task.done():
+        _flush_wakeup = asyncio.Event()
+        _flusher_task = asyncio.create_task(_flusher_loop())
+
+
+async def close_state() -> None:
+    # Остановить фоновую запись, сбросить всё на диск, свернуть журнал.
+    global _flusher_task
+
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
 
-user_settings = {chat_id: settings for chat_id, settings in _loaded_user_settings.items()}
-known_users = set(_loaded_known_users)
+    if store is None:
+        return
 
+    await flush_users()
 
-def save_state() -> None:
-    # Сохранить user settings и known users в JSON.
-    _save_state({k: dict(v) for k, v in user_settings.items()}, set(known_users))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_store_executor, store.compact)
+    await loop.run_in_executor(_store_executor, store.close)
+    _store_executor.shutdown(wait=True)
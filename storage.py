@@ -1,55 +1,292 @@
 import json
+import logging
+import mmap
 import os
-from typing import Dict, Set, Tuple
+import pickle
+import tempfile
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from user_registry import UserRegistry
+
+logger = logging.getLogger(__name__)
 
 DATA_DIR = "data"
+USERS_SNAPSHOT_FILE = os.path.join(DATA_DIR, "users.bin")
+# Прежний формат снимка, читается только для переноса в users.bin
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
+USERS_JOURNAL_FILE = os.path.join(DATA_DIR, "users.journal")
+USERS_DB_FILE = os.path.join(DATA_DIR, "users.sqlite3")
+SCHEDULE_SNAPSHOT_FILE = os.path.join(DATA_DIR, "schedule.pickle")
+FSM_DB_FILE = os.path.join(DATA_DIR, "fsm.sqlite3")
+BROADCAST_FILE = os.path.join(DATA_DIR, "broadcast.json")
+BROADCAST_DONE_FILE = os.path.join(DATA_DIR, "broadcast.done")
+
+
+# Сколько записей сейчас в журнале (после последнего снимка).
+_journal_entries = 0
+
+
+def load_state(registry: Optional[UserRegistry] = None) -> UserRegistry:
+    # Подключаем снимок users.bin и накатываем поверх него журнал изменений.
+    # Время не зависит от числа пользователей: снимок отображается в память
+    # (mmap), журнал ограничен порогом компакции.
+    global _journal_entries
+
+    if registry is None:
+        registry = UserRegistry()
+    _load_snapshot(registry)
+    _journal_entries = _replay_journal(registry)
+    return registry
+
+
+def reload_state(registry: UserRegistry) -> bool:
+    # После компакции: реестр переходит на новый users.bin. Журнал пуст,
+    # декодированные записи остаются в кэше — в новом снимке они те же.
+    try:
+        registry.attach_snapshot(_map_snapshot(), keep_cache=True)
+    except Exception as e:
+        logger.error("Не удалось прочитать %s: %s", USERS_SNAPSHOT_FILE, e)
+        return False
+    return True
 
 
-def load_state() -> Tuple[Dict[int, dict], Set[int]]:
-    # Загружаем user_settings и known_users из JSON и возвращаем их.
+def _map_snapshot() -> mmap.mmap:
+    with open(USERS_SNAPSHOT_FILE, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("пустой файл")
+        # Отображение живёт, пока на него ссылается реестр. Компакция пишет
+        # новый файл через os.replace, старое отображение остаётся валидным.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _load_snapshot(registry: UserRegistry) -> None:
+    if not os.path.exists(USERS_SNAPSHOT_FILE):
+        # Старый формат: users.json перейдёт в users.bin при первой компакции.
+        _load_legacy_json(registry)
+        return
+
+    try:
+        registry.attach_snapshot(_map_snapshot())
+    except Exception as e:
+        logger.error("Не удалось прочитать %s: %s", USERS_SNAPSHOT_FILE, e)
+
+
+def _load_legacy_json(registry: UserRegistry) -> None:
     if not os.path.exists(USERS_FILE):
-        return {}, set()
+        return
 
     try:
         with open(USERS_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
     except Exception:
-        return {}, set()
+        return
 
     raw_users = data.get("user_settings", {})
     raw_known = data.get("known_users", [])
 
-    user_settings: Dict[int, dict] = {}
-    for key, value in raw_users.items():
+    known_users: Set[int] = set()
+    for item in raw_known:
         try:
-            chat_id = int(key)
+            known_users.add(int(item))
         except (TypeError, ValueError):
             continue
-        if isinstance(value, dict):
-            user_settings[chat_id] = value
 
-    known_users: Set[int] = set()
-    for item in raw_known:
+    for key, value in raw_users.items():
         try:
-            known_users.add(int(item))
+            chat_id = int(key)
         except (TypeError, ValueError):
             continue
+        if isinstance(value, dict):
+            registry.apply(chat_id, value, chat_id in known_users)
+
+    for chat_id in known_users:
+        if chat_id not in registry:
+            registry.apply(chat_id, {}, True)
+
 
-    return user_settings, known_users
+def _replay_journal(registry: UserRegistry) -> int:
+    # Каждая запись — полное состояние одного пользователя, поэтому повторный
+    # прогон того же журнала ничего не ломает. Битую строку (обрыв при записи) пропускаем.
+    if not os.path.exists(USERS_JOURNAL_FILE):
+        return 0
 
+    entries = 0
+    with open(USERS_JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                chat_id = int(entry["id"])
+            except (ValueError, TypeError, KeyError):
+                continue
+
+            settings = entry.get("settings")
+            registry.apply(
+                chat_id,
+                settings if isinstance(settings, dict) else None,
+                bool(entry.get("known")),
+            )
+            entries += 1
+
+    return entries
+
+
+def append_user_change(chat_id: int, settings: Optional[dict], known: bool) -> None:
+    # Дописываем в журнал состояние одного пользователя (settings=None — удалён).
+    append_user_changes([(chat_id, settings, known)])
+
+
+def append_user_changes(changes: Iterable[Tuple[int, Optional[dict], bool]]) -> None:
+    # Пачка изменений одной записью в файл.
+    global _journal_entries
 
-def save_state(user_settings: Dict[int, dict], known_users: Set[int]) -> None:
-    # Сохраняем user_settings и known_users в JSON.
     os.makedirs(DATA_DIR, exist_ok=True)
 
-    data = {
-        "user_settings": {str(chat_id): settings for chat_id, settings in user_settings.items()},
-        "known_users": sorted(list(known_users)),
+    lines = [
+        json.dumps(
+            {"id": chat_id, "settings": settings, "known": known},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        + "\n"
+        for chat_id, settings, known in changes
+    ]
+    with open(USERS_JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+
+    _journal_entries += len(lines)
+
+
+def journal_size() -> int:
+    return _journal_entries
+
+
+def save_state(registry: UserRegistry) -> None:
+    # Сохраняем полный снимок в users.bin и очищаем журнал (компакция).
+    global _journal_entries
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    data = registry.to_snapshot()
+
+    tmp_path = USERS_SNAPSHOT_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+
+    os.replace(tmp_path, USERS_SNAPSHOT_FILE)
+
+    # Снимок уже содержит всё из журнала. Если упадём до этой строки,
+    # журнал просто накатится на новый снимок ещё раз.
+    open(USERS_JOURNAL_FILE, "w", encoding="utf-8").close()
+    _journal_entries = 0
+
+
+def compact_state() -> None:
+    # Сворачиваем журнал в снимок.
+    save_state(load_state())
+
+
+def load_schedule_snapshot() -> Optional[Dict[str, Any]]:
+    # Последний удачно скачанный CSV и разобранный индекс.
+    # Индекс каждой таблицы распаковывается отдельно: если классы индекса
+    # поменялись и он не читается, CSV остаётся, и индекс строится заново.
+    if not os.path.exists(SCHEDULE_SNAPSHOT_FILE):
+        return None
+
+    try:
+        with open(SCHEDULE_SNAPSHOT_FILE, "rb") as f:
+            data = pickle.load(f)
+    except Exception:
+        return None
+
+    if not isinstance(data, dict):
+        return None
+
+    sheets = data.get("sheets")
+    if isinstance(sheets, dict):
+        for url, raw in sheets.items():
+            if not isinstance(raw, dict):
+                continue
+            index = raw.get("index")
+            try:
+                raw["index"] = pickle.loads(index) if isinstance(index, bytes) else None
+            except Exception as e:
+                logger.warning("Индекс из снимка не прочитан, будет построен по CSV (%s): %s", url, e)
+                raw["index"] = None
+
+    return data
+
+
+def save_schedule_snapshot(data: Dict[str, Any]) -> None:
+    # Сохраняем снимок расписания (pickle + атомарная замена файла).
+    # Снаружи только CSV, валидаторы и даты; индекс — вложенными байтами.
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    data = dict(data)
+    data["sheets"] = {
+        url: {**raw, "index": pickle.dumps(raw.get("index"), protocol=pickle.HIGHEST_PROTOCOL)}
+        for url, raw in data.get("sheets", {}).items()
     }
 
-    tmp_path = USERS_FILE + ".tmp"
+    # Свой временный файл на каждую запись: два сохранения не пишут в один inode.
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix="schedule.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, SCHEDULE_SNAPSHOT_FILE)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_broadcast(job: Dict[str, Any]) -> None:
+    # Начало рассылки: текст и список получателей пишутся один раз,
+    # дальше только дописывается журнал доставленных (broadcast.done).
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    tmp_path = BROADCAST_FILE + ".tmp"
     with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        json.dump(job, f, ensure_ascii=False, separators=(",", ":"))
+
+    # Журнал сбрасывается, пока на диске нет задания: при падении между шагами
+    # старое задание не продолжится с пустым журналом, а новое — со старым.
+    if os.path.exists(BROADCAST_FILE):
+        os.remove(BROADCAST_FILE)
+    open(BROADCAST_DONE_FILE, "w", encoding="utf-8").close()
+    os.replace(tmp_path, BROADCAST_FILE)
+
+
+def append_broadcast_done(entries: Iterable[Tuple[int, str]]) -> None:
+    # Строка журнала: "<chat_id> <исход>".
+    lines = [f"{chat_id} {outcome}\n" for chat_id, outcome in entries]
+    with open(BROADCAST_DONE_FILE, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+
+
+def load_broadcast() -> Optional[Tuple[Dict[str, Any], Dict[int, str]]]:
+    # Незавершённая рассылка и исходы по уже обработанным чатам.
+    if not os.path.exists(BROADCAST_FILE):
+        return None
+
+    try:
+        with open(BROADCAST_FILE, "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except Exception:
+        return None
+
+    done: Dict[int, str] = {}
+    if os.path.exists(BROADCAST_DONE_FILE):
+        with open(BROADCAST_DONE_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                chat_id, _, outcome = line.strip().partition(" ")
+                try:
+                    done[int(chat_id)] = outcome
+                except ValueError:
+                    continue
+
+    return job, done
+
 
-    os.replace(tmp_path, USERS_FILE)
+def clear_broadcast() -> None:
+    for path in (BROADCAST_FILE, BROADCAST_DONE_FILE):
+        if os.path.exists(path):
+            os.remove(path)
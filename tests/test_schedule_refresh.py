@@ -0,0 +1,138 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+# config требует токен, но тест в Telegram не ходит.
+os.environ.setdefault("TOKEN_BOT", "test")
+
+import shedule  # noqa: E402
+from benchmarks.sheet_generator import generate_sheet_csv  # noqa: E402
+
+
+class _SheetServer:
+    # Локальная замена Google Sheets: отдаёт CSV с ETag, отвечает 304 на
+    # If-None-Match и сжимает ответ, если клиент просит gzip.
+
+    def __init__(self, body: str, etag: bool = True, delay: float = 0.0):
+        self.body = body
+        self.etag = etag
+        self.delay = delay
+        self.requests = []
+        self.runner = None
+        self.url = ""
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests.append(dict(request.headers))
+        await asyncio.sleep(self.delay)
+
+        tag = f'"{hash(self.body)}"'
+        if self.etag and request.headers.get("If-None-Match") == tag:
+            return web.Response(status=304)
+
+        response = web.Response(text=self.body, content_type="text/csv")
+        if self.etag:
+            response.headers["ETag"] = tag
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.enable_compression(web.ContentCoding.gzip)
+        return response
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/sheet.csv", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/sheet.csv"
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class ScheduleRefreshTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.csv_text = generate_sheet_csv(1, 3)
+        # Снимок на диск не пишем, таблицы из config не трогаем.
+        self.patches = [
+            mock.patch.object(shedule, "save_schedule_snapshot"),
+            mock.patch.dict(shedule._sheets, clear=True),
+            mock.patch.dict(shedule._sheet_by_parallel, clear=True),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self) -> None:
+        await shedule.close_http_session()
+        shedule.shutdown_parse_executor()
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    async def _serve(self, **kwargs) -> "tuple[_SheetServer, shedule.SheetCache]":
+        server = _SheetServer(self.csv_text, **kwargs)
+        await server.start()
+        self.addAsyncCleanup(server.stop)
+        sheet = shedule.SheetCache(url=server.url)
+        shedule._sheets[sheet.url] = sheet
+        return server, sheet
+
+    async def test_gzip_and_not_modified(self) -> None:
+        server, sheet = await self._serve()
+
+        self.assertTrue(await shedule.refresh_now())
+        self.assertIn("gzip", server.requests[0].get("Accept-Encoding", ""))
+        self.assertEqual(sheet.csv_text, self.csv_text)
+        self.assertIsNotNone(sheet.etag)
+        index = sheet.index
+
+        # Таблица не менялась: условный запрос, 304, индекс тот же.
+        self.assertTrue(await shedule.refresh_now())
+        self.assertEqual(server.requests[1].get("If-None-Match"), sheet.etag)
+        self.assertIs(sheet.index, index)
+
+        # Таблица изменилась: новый ETag, индекс пересобран.
+        server.body = generate_sheet_csv(1, 3, seed=1)
+        self.assertTrue(await shedule.refresh_now())
+        self.assertEqual(sheet.csv_text, server.body)
+        self.assertIsNot(sheet.index, index)
+
+    async def test_same_hash_keeps_index(self) -> None:
+        # Без ETag сервер всегда отдаёт тело целиком — спасает хэш.
+        server, sheet = await self._serve(etag=False)
+
+        self.assertTrue(await shedule.refresh_now())
+        csv_text, index = sheet.csv_text, sheet.index
+
+        self.assertTrue(await shedule.refresh_now())
+        self.assertEqual(len(server.requests), 2)
+        self.assertIs(sheet.csv_text, csv_text)
+        self.assertIs(sheet.index, index)
+
+    async def test_forced_refresh_skips_validators(self) -> None:
+        server, sheet = await self._serve()
+
+        self.assertTrue(await shedule.refresh_now())
+        index = sheet.index
+
+        self.assertTrue(await shedule.refresh_now(force=True))
+        self.assertNotIn("If-None-Match", server.requests[1])
+        self.assertIsNot(sheet.index, index)
+
+    async def test_cold_requests_share_one_download(self) -> None:
+        server, sheet = await self._serve(delay=0.1)
+        coalesced = shedule.coalesced_requests
+
+        results = await asyncio.gather(
+            *(shedule._get_sheet_text_cached(sheet) for _ in range(20))
+        )
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertTrue(all(text == self.csv_text for text in results))
+        self.assertEqual(shedule.coalesced_requests - coalesced, 19)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,550 @@
+import bisect
+import heapq
+import logging
+import struct
+import sys
+import weakref
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, settings, known) — строка внешнего хранилища
+UserRow = Tuple[int, Dict[str, Any], bool]
+
+# Поля профиля в порядке хранения в снимке.
+_STRING_FIELDS = (
+    "first_name",
+    "last_name",
+    "parallel",
+    "variant",
+    "other_parallel",
+    "other_variant",
+)
+_CLASS_FIELDS = frozenset(("parallel", "variant", "other_parallel", "other_variant"))
+_SETTINGS_FIELDS = _STRING_FIELDS + ("notify_changes",)
+SETTINGS_KEYS = frozenset(_SETTINGS_FIELDS)
+
+# Флаги записи в снимке
+_FLAG_KNOWN = 1
+_FLAG_NOTIFY_SET = 2
+_FLAG_NOTIFY = 4
+
+# Снимок users.bin (little-endian):
+#   заголовок: magic, число пользователей, число строк, длина блока строк
+#   chat_id:   int64 × count, по возрастанию (для бинарного поиска)
+#   записи:    (uint32 × 6 — номера строк, uint8 — флаги) × count
+#   смещения:  uint32 × (строк + 1) в блоке строк
+#   строки:    UTF-8 подряд
+# Номер строки 0 — «нет значения», строки нумеруются с 1.
+# Колонки читаются прямо из mmap, без копирования.
+SNAPSHOT_MAGIC = b"TGU1"
+_HEADER = struct.Struct("<4sIII")
+_RECORD = struct.Struct("<6IB")
+_NO_STRING = 0
+_EMPTY_SNAPSHOT = _HEADER.pack(SNAPSHOT_MAGIC, 0, 0, 0) + bytes(4)
+
+
+class UserRecord:
+    # Профиль одного пользователя. Доступ как к dict (settings.get("parallel"),
+    # settings["variant"] = ...), чтобы хендлеры не зависели от формата хранения.
+    __slots__ = _SETTINGS_FIELDS + ("known", "__weakref__")
+
+    def __init__(
+        self,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+        parallel: Optional[str] = None,
+        variant: Optional[str] = None,
+        other_parallel: Optional[str] = None,
+        other_variant: Optional[str] = None,
+        notify_changes: Optional[bool] = None,
+        known: bool = False,
+    ):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.parallel = parallel
+        self.variant = variant
+        self.other_parallel = other_parallel
+        self.other_variant = other_variant
+        self.notify_changes = notify_changes
+        self.known = known
+
+    @classmethod
+    def from_dict(cls, settings: Dict[str, Any], known: bool = False) -> "UserRecord":
+        record = cls(known=known)
+        for key, value in settings.items():
+            if key in SETTINGS_KEYS and value is not None:
+                record[key] = value
+        return record
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            key: value
+            for key in _SETTINGS_FIELDS
+            if (value := getattr(self, key)) is not None
+        }
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key) if key in SETTINGS_KEYS else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in SETTINGS_KEYS:
+            raise KeyError(key)
+        if key in _CLASS_FIELDS and isinstance(value, str):
+            # "эконом 2" у тысяч пользователей — одна и та же строка в памяти.
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = self.get(key, default)
+        if key in SETTINGS_KEYS:
+            setattr(self, key, None)
+        return value
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r}, known={self.known})"
+
+
+def _class_key(record: Optional[UserRecord]) -> Optional[Tuple[str, str]]:
+    if record is None or not record.parallel or not record.variant:
+        return None
+    return record.parallel, record.variant
+
+
+class UserRegistry:
+    # Все пользователи бота: chat_id -> UserRecord.
+    # Основа — колонки снимка (обычно mmap файла), записи из него декодируются
+    # при первом обращении и держатся в ограниченном LRU (_hot). Новые,
+    # изменённые и удалённые (None) записи лежат в _changed и не вытесняются,
+    # пока не окажутся в основе (release после записи на диск).
+    # Вместо снимка основой может быть внешний источник (SQLite, см.
+    # attach_source). Его читают вне event loop (state.load_user и др.) и
+    # передают сюда результат: remember, known_ids(base), class_records(rows).
+
+    def __init__(self, cache_size: int = 10000) -> None:
+        self.cache_size = cache_size
+        self._ids: Sequence[int] = array("q")
+        self._records: memoryview = memoryview(b"")
+        self._offsets: Sequence[int] = array("I", [0])
+        self._blob: memoryview = memoryview(b"")
+        self._class_strings: Dict[int, str] = {}
+        self._changed: Dict[int, Optional[UserRecord]] = {}
+        self._hot: "OrderedDict[int, UserRecord]" = OrderedDict()
+        # Вытесненная из _hot запись, которую ещё держит хендлер, должна
+        # остаться тем же объектом, иначе его изменения потеряются.
+        self._alive: "weakref.WeakValueDictionary[int, UserRecord]" = weakref.WeakValueDictionary()
+        self._count = 0
+        # Обратный индекс (параллель, класс) -> chat_id: отсортированные массивы
+        # по снимку (строятся при первом обращении) и текущий класс для записей
+        # из _changed, которые перекрывают снимок.
+        self._class_base: Optional[Dict[Tuple[str, str], Sequence[int]]] = None
+        self._class_overrides: Dict[int, Optional[Tuple[str, str]]] = {}
+        self._source: Any = None
+        # chat_id, которых нет в источнике (чтобы не спрашивать его повторно).
+        self._missing: "OrderedDict[int, None]" = OrderedDict()
+
+    @classmethod
+    def from_snapshot(cls, data: Any, cache_size: int = 10000) -> "UserRegistry":
+        registry = cls(cache_size)
+        registry.attach_snapshot(data)
+        return registry
+
+    def attach_snapshot(self, data: Any, keep_cache: bool = False) -> None:
+        # data — bytes или mmap со снимком. Читается только заголовок.
+        # keep_cache — новый снимок свёрнут из старого и записанных изменений,
+        # поэтому уже декодированные записи в нём те же.
+        view = memoryview(data)
+        magic, count, string_count, blob_size = _HEADER.unpack_from(view, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Неизвестный формат снимка пользователей")
+
+        pos = _HEADER.size
+        ids_end = pos + count * 8
+        records_end = ids_end + count * _RECORD.size
+        offsets_end = records_end + (string_count + 1) * 4
+        if offsets_end + blob_size != len(view):
+            raise ValueError("Снимок пользователей обрезан или повреждён")
+
+        if sys.byteorder == "little":
+            self._ids = view[pos:ids_end].cast("q")
+            self._offsets = view[records_end:offsets_end].cast("I")
+        else:
+            self._ids = array("q", view[pos:ids_end].tobytes())
+            self._offsets = array("I", view[records_end:offsets_end].tobytes())
+            self._ids.byteswap()
+            self._offsets.byteswap()
+        self._records = view[ids_end:records_end]
+        self._blob = view[offsets_end:]
+        self._class_strings = {}
+        if not keep_cache:
+            self._hot.clear()
+            self._alive.clear()
+        self._class_base = None
+        self._source = None
+        self._missing.clear()
+        self._count = count + sum(
+            (record is not None) - (self._find(chat_id) >= 0)
+            for chat_id, record in self._changed.items()
+        )
+
+    def attach_source(self, source: Any) -> None:
+        # source вместо снимка: get(chat_id) -> (chat_id, settings, known) или None,
+        # count(), known_ids(), class_rows(parallel, variant) и iterate() по
+        # возрастанию chat_id. Реестр сам зовёт его только как запасной путь,
+        # если запись не прочитали заранее.
+        self.attach_snapshot(_EMPTY_SNAPSHOT)
+        self._source = source
+        self._count = source.count() + sum(
+            (record is not None) - (source.get(chat_id) is not None)
+            for chat_id, record in self._changed.items()
+        )
+
+    # Снимок
+
+    def _string(self, ref: int) -> Optional[str]:
+        if ref == _NO_STRING:
+            return None
+        return str(self._blob[self._offsets[ref - 1]:self._offsets[ref]], "utf-8")
+
+    def _class_string(self, ref: int) -> Optional[str]:
+        # Названия классов повторяются у тысяч пользователей — декодируем один раз.
+        value = self._class_strings.get(ref)
+        if value is None and ref != _NO_STRING:
+            value = self._class_strings[ref] = sys.intern(self._string(ref))
+        return value
+
+    def _find(self, chat_id: int) -> int:
+        pos = bisect.bisect_left(self._ids, chat_id)
+        if pos < len(self._ids) and self._ids[pos] == chat_id:
+            return pos
+        return -1
+
+    def _load(self, chat_id: int) -> Optional[UserRecord]:
+        # Запись из основы (снимка или источника), без кэша.
+        if self._source is not None:
+            if chat_id in self._missing:
+                return None
+            logger.warning("Пользователь %s не прочитан заранее, чтение базы в event loop", chat_id)
+            row = self._source.get(chat_id)
+            return None if row is None else UserRecord.from_dict(row[1], row[2])
+        pos = self._find(chat_id)
+        return self._decode(pos) if pos >= 0 else None
+
+    def _decode(self, pos: int) -> UserRecord:
+        first, last, *class_refs, flags = _RECORD.unpack_from(self._records, pos * _RECORD.size)
+        return UserRecord(
+            self._string(first),
+            self._string(last),
+            *(self._class_string(ref) for ref in class_refs),
+            notify_changes=bool(flags & _FLAG_NOTIFY) if flags & _FLAG_NOTIFY_SET else None,
+            known=bool(flags & _FLAG_KNOWN),
+        )
+
+    def to_snapshot(self) -> bytes:
+        refs: Dict[str, int] = {}
+        encoded: List[bytes] = []
+
+        def ref(value: Optional[str]) -> int:
+            if value is None:
+                return _NO_STRING
+            number = refs.get(value)
+            if number is None:
+                encoded.append(value.encode("utf-8"))
+                number = refs[value] = len(encoded)
+            return number
+
+        ids = array("q")
+        records = bytearray()
+        pack = _RECORD.pack
+        for chat_id, record in self.items():
+            flags = _FLAG_KNOWN if record.known else 0
+            if record.notify_changes is not None:
+                flags |= _FLAG_NOTIFY_SET
+                if record.notify_changes:
+                    flags |= _FLAG_NOTIFY
+            ids.append(chat_id)
+            records += pack(*(ref(getattr(record, field)) for field in _STRING_FIELDS), flags)
+
+        offsets = array("I", [0])
+        total = 0
+        for item in encoded:
+            total += len(item)
+            offsets.append(total)
+
+        if sys.byteorder != "little":
+            ids.byteswap()
+            offsets.byteswap()
+
+        return b"".join((
+            _HEADER.pack(SNAPSHOT_MAGIC, len(ids), len(encoded), total),
+            ids.tobytes(),
+            bytes(records),
+            offsets.tobytes(),
+            *encoded,
+        ))
+
+    # Доступ
+
+    def get(self, chat_id: int, default: Any = None) -> Any:
+        if chat_id in self._changed:
+            record = self._changed[chat_id]
+            return default if record is None else record
+
+        record = self._hot.get(chat_id)
+        if record is not None:
+            self._hot.move_to_end(chat_id)
+            return record
+
+        record = self._alive.get(chat_id)
+        if record is None:
+            record = self._load(chat_id)
+            if record is None:
+                return default
+            self._alive[chat_id] = record
+
+        self._cache(chat_id, record)
+        return record
+
+    def _cache(self, chat_id: int, record: UserRecord) -> None:
+        self._hot[chat_id] = record
+        self._hot.move_to_end(chat_id)
+        if len(self._hot) > self.cache_size:
+            self._hot.popitem(last=False)
+
+    def ensure(self, chat_id: int) -> UserRecord:
+        # Запись пользователя, новая пустая — если его ещё нет.
+        record = self.get(chat_id)
+        if record is None:
+            record = self._changed[chat_id] = UserRecord()
+            self._missing.pop(chat_id, None)
+            self._count += 1
+        return record
+
+    @property
+    def lazy(self) -> bool:
+        # Основа — внешний источник, его читают вне event loop.
+        return self._source is not None
+
+    def needs_load(self, chat_id: int) -> bool:
+        # Записи нет в памяти, и источник о ней ещё не спрашивали.
+        return (
+            self._source is not None
+            and chat_id not in self._changed
+            and chat_id not in self._hot
+            and chat_id not in self._alive
+            and chat_id not in self._missing
+        )
+
+    def remember(self, chat_id: int, row: Optional[UserRow]) -> Optional[UserRecord]:
+        # Результат чтения источника вне event loop. Пока читали, запись могла
+        # появиться в памяти — тогда она новее.
+        if not self.needs_load(chat_id):
+            return self.peek(chat_id)
+        if row is None:
+            self._missing[chat_id] = None
+            if len(self._missing) > self.cache_size:
+                self._missing.popitem(last=False)
+            return None
+        record = self._alive[chat_id] = UserRecord.from_dict(row[1], row[2])
+        self._cache(chat_id, record)
+        return record
+
+    def release(self, chat_ids: Iterable[int]) -> None:
+        # Эти записи уже в основе (записаны в базу или свёрнуты в новый снимок):
+        # из _changed — обратно в LRU, тем же объектом.
+        for chat_id in chat_ids:
+            record = self._changed.get(chat_id)
+            if record is None:
+                continue
+            del self._changed[chat_id]
+            self._class_overrides.pop(chat_id, None)
+            self._alive[chat_id] = record
+            self._cache(chat_id, record)
+
+    def mark_changed(self, chat_id: int) -> None:
+        # Запись изменена и расходится со снимком — из кэша её вытеснять нельзя.
+        # Здесь же обновляется индекс по классам: хендлеры, меняющие класс
+        # (/start, выбор и смена класса), всегда помечают запись изменённой.
+        if chat_id not in self._changed:
+            record = self.get(chat_id)
+            if record is None:
+                return
+            self._hot.pop(chat_id, None)
+            self._changed[chat_id] = record
+        self._class_overrides[chat_id] = _class_key(self._changed[chat_id])
+
+    def apply(self, chat_id: int, settings: Optional[Dict[str, Any]], known: bool) -> None:
+        # Полное состояние пользователя (из журнала или другого хранилища).
+        if settings is None and not known:
+            self.delete(chat_id)
+            return
+
+        if chat_id not in self:
+            self._count += 1
+        self._hot.pop(chat_id, None)
+        self._alive.pop(chat_id, None)
+        self._missing.pop(chat_id, None)
+        record = self._changed[chat_id] = UserRecord.from_dict(settings or {}, known)
+        self._class_overrides[chat_id] = _class_key(record)
+
+    def delete(self, chat_id: int) -> None:
+        if chat_id in self:
+            self._count -= 1
+            self._hot.pop(chat_id, None)
+            self._alive.pop(chat_id, None)
+            self._changed[chat_id] = None
+            self._class_overrides[chat_id] = None
+
+    def peek(self, chat_id: int) -> Optional[UserRecord]:
+        # Как get, но без записи в кэш — для массовых обходов.
+        if chat_id in self._changed:
+            return self._changed[chat_id]
+        return self._hot.get(chat_id) or self._alive.get(chat_id) or self._load(chat_id)
+
+    def __contains__(self, chat_id: int) -> bool:
+        if chat_id in self._changed:
+            return self._changed[chat_id] is not None
+        if chat_id in self._hot or chat_id in self._alive:
+            return True
+        if self._source is not None:
+            return self._load(chat_id) is not None
+        return self._find(chat_id) >= 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        for chat_id, _ in self.items():
+            yield chat_id
+
+    def items(self) -> Iterator[Tuple[int, UserRecord]]:
+        # По возрастанию chat_id. Записи из снимка в кэш не попадают.
+        changed = self._changed
+        alive = self._alive
+        if self._source is not None:
+            yield from heapq.merge(
+                (
+                    (chat_id, alive.get(chat_id) or UserRecord.from_dict(settings, known))
+                    for chat_id, settings, known in self._source.iterate()
+                    if chat_id not in changed
+                ),
+                sorted((chat_id, record) for chat_id, record in changed.items() if record is not None),
+                key=lambda item: item[0],
+            )
+            return
+
+        added = sorted(chat_id for chat_id in changed if self._find(chat_id) < 0)
+        merged = heapq.merge(
+            ((chat_id, pos) for pos, chat_id in enumerate(self._ids)),
+            ((chat_id, -1) for chat_id in added),
+        )
+        for chat_id, pos in merged:
+            if chat_id in changed:
+                record = changed[chat_id]
+            else:
+                record = alive.get(chat_id) or self._decode(pos)
+            if record is not None:
+                yield chat_id, record
+
+    def known_ids(self, base: Optional[Iterable[int]] = None) -> List[int]:
+        # Флаг known читаем прямо из снимка, не декодируя записи.
+        # base — known chat_id из источника, прочитанные вне event loop.
+        changed = self._changed
+        if base is None and self._source is not None:
+            base = self._source.known_ids()
+        if base is not None:
+            result = [chat_id for chat_id in base if chat_id not in changed]
+        else:
+            result = []
+            records = self._records
+            flag_at = _RECORD.size - 1
+            for pos, chat_id in enumerate(self._ids):
+                if chat_id in changed:
+                    continue
+                if records[pos * _RECORD.size + flag_at] & _FLAG_KNOWN:
+                    result.append(chat_id)
+        result.extend(
+            chat_id for chat_id, record in changed.items() if record is not None and record.known
+        )
+        return result
+
+    # Индекс по классам
+
+    def build_class_index(self) -> None:
+        # Один проход по колонке записей снимка, строки не декодируются.
+        # Снимок не меняется, поэтому можно вызывать из другого потока.
+        # У источника свой индекс, class_members спрашивает его напрямую.
+        if self._source is not None:
+            return
+
+        groups: Dict[Tuple[int, int], array] = {}
+        ids = self._ids
+        for pos, (_, _, parallel, variant, *_) in enumerate(_RECORD.iter_unpack(self._records)):
+            if parallel != _NO_STRING and variant != _NO_STRING:
+                members = groups.get((parallel, variant))
+                if members is None:
+                    members = groups[parallel, variant] = array("q")
+                members.append(ids[pos])
+
+        self._class_base = {
+            (self._class_string(parallel), self._class_string(variant)): members
+            for (parallel, variant), members in groups.items()
+        }
+
+    def class_members(self, parallel: str, variant: str) -> List[int]:
+        # chat_id всех пользователей, у которых свой класс — parallel/variant.
+        return [chat_id for chat_id, _ in self.class_records(parallel, variant)]
+
+    def class_records(
+        self,
+        parallel: str,
+        variant: str,
+        rows: Optional[Iterable[UserRow]] = None,
+    ) -> List[Tuple[int, UserRecord]]:
+        # Пользователи класса вместе с записями, без записи в кэш.
+        # rows — строки этого класса из источника, прочитанные вне event loop.
+        key = (parallel, variant)
+        overrides = self._class_overrides
+        if rows is None and self._source is not None:
+            rows = self._source.class_rows(parallel, variant)
+
+        if rows is not None:
+            alive = self._alive
+            result = [
+                (chat_id, alive.get(chat_id) or UserRecord.from_dict(settings, known))
+                for chat_id, settings, known in rows
+                if chat_id not in overrides
+            ]
+        else:
+            if self._class_base is None:
+                self.build_class_index()
+            result = [
+                (chat_id, self.peek(chat_id))
+                for chat_id in self._class_base.get(key, ())
+                if chat_id not in overrides
+            ]
+        result.extend(
+            (chat_id, self._changed[chat_id])
+            for chat_id, current in overrides.items()
+            if current == key
+        )
+        return result
+
+    def memory_stats(self) -> Dict[str, int]:
+        return {
+            "snapshot": len(self._ids),
+            "hot": len(self._hot),
+            "changed": len(self._changed),
+        }
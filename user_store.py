@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List, Optional, Set
+
+import storage
+from config import USER_STORE_BACKEND
+from user_registry import UserRegistry, UserRow
+
+logger = logging.getLogger(__name__)
+
+
+class UserStore(ABC):
+    # Хранилище пользователей. Методы синхронные: state вызывает их
+    # из отдельного потока, не из event loop.
+
+    @abstractmethod
+    def get(self, chat_id: int) -> Optional[UserRow]:
+        ...
+
+    @abstractmethod
+    def upsert(self, chat_id: int, settings: dict, known: bool) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, chat_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def iterate(self) -> Iterator[UserRow]:
+        ...
+
+    def upsert_many(self, rows: Iterable[UserRow]) -> None:
+        for chat_id, settings, known in rows:
+            self.upsert(chat_id, settings, known)
+
+    def load_registry(self, registry: UserRegistry) -> None:
+        # Заполнить реестр при старте бота. По умолчанию читает всех пользователей.
+        for chat_id, settings, known in self.iterate():
+            registry.apply(chat_id, settings, known)
+
+    def flushed(self, registry: UserRegistry, written: Iterable[int], pinned: Set[int]) -> bool:
+        # Вызывается из event loop после удачной записи written. Хранилище решает,
+        # какие записи реестру больше не нужно держать в _changed (pinned — снова
+        # изменены, их держим). True — основа реестра сменилась.
+        return False
+
+    def compact(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FileUserStore(UserStore):
+    # Снимок users.bin + журнал изменений (см. storage.py).
+    # Данные в памяти не держит: снимок читается только при загрузке и компакции.
+
+    def __init__(self, compact_threshold: int = 5000):
+        self.compact_threshold = compact_threshold
+        # Записанные после последней компакции и сама компакция: пока снимок
+        # не свёрнут, эти записи есть только в журнале, и реестр их держит.
+        self._written: Set[int] = set()
+        self._compacted = False
+
+    def get(self, chat_id: int) -> Optional[UserRow]:
+        # Читает снимок целиком — для файлового хранилища это редкая операция.
+        record = storage.load_state().get(chat_id)
+        if record is None:
+            return None
+        return chat_id, record.to_dict(), record.known
+
+    def upsert(self, chat_id: int, settings: dict, known: bool) -> None:
+        self.upsert_many([(chat_id, settings, known)])
+
+    def upsert_many(self, rows: Iterable[UserRow]) -> None:
+        rows = list(rows)
+        storage.append_user_changes(rows)
+        self._written.update(chat_id for chat_id, _, _ in rows)
+        if storage.journal_size() >= self.compact_threshold:
+            self.compact()
+
+    def delete(self, chat_id: int) -> None:
+        storage.append_user_change(chat_id, None, False)
+
+    def iterate(self) -> Iterator[UserRow]:
+        for chat_id, record in storage.load_state().items():
+            yield chat_id, record.to_dict(), record.known
+
+    def load_registry(self, registry: UserRegistry) -> None:
+        # Снимок отображается в память, записи декодируются при обращении.
+        storage.load_state(registry)
+
+    def flushed(self, registry: UserRegistry, written: Iterable[int], pinned: Set[int]) -> bool:
+        # После компакции реестр переходит на новый users.bin и отпускает всё,
+        # что в него попало.
+        if not self._compacted:
+            return False
+        self._compacted = False
+        if not storage.reload_state(registry):
+            return False
+        registry.release(chat_id for chat_id in self._written if chat_id not in pinned)
+        self._written.clear()
+        return True
+
+    def compact(self) -> None:
+        # Заодно переводит старый users.json в users.bin.
+        if storage.journal_size() or not os.path.exists(storage.USERS_SNAPSHOT_FILE):
+            storage.compact_state()
+            self._compacted = True
+
+
+class _SqliteReads:
+    # Чтение таблицы users; соединение — у наследника.
+    conn: sqlite3.Connection
+
+    def get(self, chat_id: int) -> Optional[UserRow]:
+        row = self.conn.execute(
+            "SELECT settings, known FROM users WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return chat_id, json.loads(row[0]), bool(row[1])
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def known_ids(self) -> List[int]:
+        return [row[0] for row in self.conn.execute("SELECT chat_id FROM users WHERE known = 1")]
+
+    def class_rows(self, parallel: str, variant: str) -> List[UserRow]:
+        # По индексу users_by_class.
+        cursor = self.conn.execute(
+            "SELECT chat_id, settings, known FROM users WHERE parallel = ? AND variant = ?",
+            (parallel, variant),
+        )
+        return [(chat_id, json.loads(settings), bool(known)) for chat_id, settings, known in cursor]
+
+    def iterate(self) -> Iterator[UserRow]:
+        cursor = self.conn.execute("SELECT chat_id, settings, known FROM users ORDER BY chat_id")
+        for chat_id, settings, known in cursor:
+            yield chat_id, json.loads(settings), bool(known)
+
+
+class SqliteUserStore(_SqliteReads, UserStore):
+    # SQLite в режиме WAL. parallel/variant вынесены в индексируемые колонки,
+    # полный профиль лежит в settings (JSON). Все методы — в потоке хранилища.
+
+    _UPSERT_SQL = (
+        "INSERT INTO users (chat_id, parallel, variant, known, settings) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET "
+        "parallel = excluded.parallel, variant = excluded.variant, "
+        "known = excluded.known, settings = excluded.settings"
+    )
+
+    def __init__(self, path: str = storage.USERS_DB_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._source: Optional[SqliteUserSource] = None
+        # Соединение используется одним потоком хранилища (и при старте — главным).
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "chat_id INTEGER PRIMARY KEY, "
+            "parallel TEXT, "
+            "variant TEXT, "
+            "known INTEGER NOT NULL DEFAULT 0, "
+            "settings TEXT NOT NULL DEFAULT '{}')"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS users_by_class ON users (parallel, variant)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _params(chat_id: int, settings: dict, known: bool) -> tuple:
+        return (
+            chat_id,
+            settings.get("parallel"),
+            settings.get("variant"),
+            1 if known else 0,
+            json.dumps(settings, ensure_ascii=False, separators=(",", ":")),
+        )
+
+    def upsert(self, chat_id: int, settings: dict, known: bool) -> None:
+        with self.conn:
+            self.conn.execute(self._UPSERT_SQL, self._params(chat_id, settings, known))
+
+    def upsert_many(self, rows: Iterable[UserRow]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                self._UPSERT_SQL,
+                (self._params(chat_id, settings, known) for chat_id, settings, known in rows),
+            )
+
+    def delete(self, chat_id: int) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+
+    def load_registry(self, registry: UserRegistry) -> None:
+        # Строки не читаются: state дочитывает пользователей при обращении
+        # (load_user, known_ids, class_records) в потоке хранилища.
+        self._source = SqliteUserSource(self.path)
+        registry.attach_source(self._source)
+
+    def flushed(self, registry: UserRegistry, written: Iterable[int], pinned: Set[int]) -> bool:
+        # Записанное уже в базе — его можно снова читать оттуда.
+        registry.release(chat_id for chat_id in written if chat_id not in pinned)
+        return False
+
+    def close(self) -> None:
+        self.conn.close()
+        if self._source is not None:
+            self._source.close()
+
+
+class SqliteUserSource(_SqliteReads):
+    # Запасной путь реестра, если запись не прочитали заранее: своё соединение
+    # для event loop (основное занято потоком хранилища, WAL читает параллельно).
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA query_only=ON")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def migrate_json_to_sqlite(db_path: str = storage.USERS_DB_FILE) -> int:
+    # Разовый перенос файлового хранилища (снимок + журнал) в SQLite. Возвращает число пользователей.
+    source = FileUserStore()
+    target = SqliteUserStore(db_path)
+    try:
+        rows = list(source.iterate())
+        target.upsert_many(rows)
+    finally:
+        target.close()
+    return len(rows)
+
+
+def open_user_store() -> UserStore:
+    if USER_STORE_BACKEND == "sqlite":
+        has_files = os.path.exists(storage.USERS_SNAPSHOT_FILE) or os.path.exists(storage.USERS_FILE)
+        if not os.path.exists(storage.USERS_DB_FILE) and has_files:
+            migrated = migrate_json_to_sqlite()
+            logger.info("Пользователи перенесены из файлов в SQLite: %d", migrated)
+        return SqliteUserStore()
+
+    if USER_STORE_BACKEND != "json":
+        logger.warning("Неизвестное хранилище пользователей %r, используется json.", USER_STORE_BACKEND)
+    return FileUserStore()
+
+
+if __name__ == "__main__":
+    # python user_store.py migrate
+    if sys.argv[1:] != ["migrate"]:
+        print("Использование: python user_store.py migrate")
+        sys.exit(1)
+    print(f"Перенесено пользователей: {migrate_json_to_sqlite()}")
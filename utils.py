@@ -1,4 +1,6 @@
 import random
+import zlib
+from typing import List, Optional
 
 from aiogram.types import Message
 
@@ -9,22 +11,29 @@ def normalize_spaces(s: str) -> str:
     return " ".join(s.split())
 
 
-async def send_long_text(message: Message, text: str) -> None:
+def split_long_text(text: str) -> List[str]:
     # Разбиваем по строкам, чтобы не рвать дни, уроки.
     if len(text) <= MAX_MESSAGE_LENGTH:
-        await message.answer(text)
-        return
+        return [text]
 
+    chunks: List[str] = []
     current_chunk = ""
 
     for line in text.splitlines(keepends=True):
         if len(current_chunk) + len(line) > MAX_MESSAGE_LENGTH:
-            await message.answer(current_chunk)
+            chunks.append(current_chunk)
             current_chunk = ""
         current_chunk += line
 
     if current_chunk:
-        await message.answer(current_chunk)
+        chunks.append(current_chunk)
+
+    return chunks
+
+
+async def send_long_text(message: Message, text: str) -> None:
+    for chunk in split_long_text(text):
+        await message.answer(chunk)
 
 
 def is_admin(user_id: int) -> bool:
@@ -42,5 +51,8 @@ FREE_TIME_TEXTS = [
 ]
 
 
-def get_free_time_text() -> str:
-    return random.choice(FREE_TIME_TEXTS)
+def get_free_time_text(seed: Optional[str] = None) -> str:
+    # С seed фраза всегда одна и та же, чтобы готовый текст можно было кэшировать.
+    if seed is None:
+        return random.choice(FREE_TIME_TEXTS)
+    return FREE_TIME_TEXTS[zlib.crc32(seed.encode("utf-8")) % len(FREE_TIME_TEXTS)]